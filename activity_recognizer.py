@@ -4,15 +4,349 @@
 """
 The ActivityRecognizer module takes care of the activity recognition.
 
+The SVM is trained once and saved together with its metadata in activity.model.
+It is trained again at startup only, when the training files have changed.
+The training files are csv recordings in training/<activity>/,
+training/manifest.json defines the order of the activity labels.
+Training can also be started manually with:
+    python3 activity_recognizer.py train
+
 Author: Fabian Zürcher
 """
 
 import csv
+import hashlib
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from sklearn import svm
-from pyqtgraph.Qt import QtGui, QtCore
-from numpy import sin, linspace, pi
-from scipy import fft, arange
+from sklearn.model_selection import StratifiedKFold, cross_val_score
+
+
+def load_samples(filename):
+    # Loads a csv file of x, y, z accelerometer values into an (n, 3) int16 array.
+    return np.loadtxt(filename, delimiter=",", dtype=np.int16, ndmin=2)
+
+
+def features(window_array):
+    # Calculates the features of one (n, 3) window of accelerometer samples
+    # or of many stacked (k, n, 3) windows at once.
+    # The axes are averaged per sample and the magnitude spectrum
+    # without the DC bin is calculated with a real FFT.
+    # Training and prediction both use this function.
+    avg = np.asarray(window_array, dtype=np.float32).mean(axis=-1)
+    n = avg.shape[-1]
+    return np.abs(np.fft.rfft(avg, axis=-1) / n)[..., 1:n // 2]
+
+
+class RingBuffer():
+
+    """
+    RingBuffer keeps the latest accelerometer samples in a fixed-capacity
+    NumPy array. Every sample is stored twice, so the latest samples are
+    always a contiguous slice and can be read without copying.
+    """
+
+    def __init__(self, capacity, channels=3, dtype=np.int16):
+        self.capacity = capacity
+        self.data = np.zeros((2 * capacity, channels), dtype=dtype)
+        self.pos = 0
+        self.count = 0
+        # Amount of all samples ever appended.
+        self.total = 0
+
+    def __len__(self):
+        return self.count
+
+    # Adds a sample, the oldest one is dropped when the buffer is full.
+    def append(self, sample):
+        pos = self.pos
+        self.data[pos] = sample
+        self.data[pos + self.capacity] = sample
+        self.pos = (pos + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.total += 1
+
+    # Returns a read-only view on the latest n samples, oldest first.
+    # The view is not copied, so it changes when new samples are appended.
+    def latest(self, n=None):
+        if n is None or n > self.count:
+            n = self.count
+        end = self.pos + self.capacity
+        window = self.data[end - n:end]
+        window.flags.writeable = False
+        return window
+
+    def clear(self):
+        self.pos = 0
+        self.count = 0
+
+    # Writes the buffered samples into a CSV file.
+    def to_csv(self, filename):
+        samples = np.array(self.latest())
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerows(samples.tolist())
+
+
+class SlidingSpectrum():
+
+    """
+    SlidingSpectrum tracks the features of the latest n samples incrementally
+    with a sliding DFT. Every new sample updates only the bins used by the SVM,
+    so no window has to be copied and transformed for a prediction.
+    The features are the same as the ones of features() for the same window.
+    """
+
+    # The bins are calculated exactly again after this amount of samples,
+    # as the rounding errors of the recursive update accumulate.
+    RESYNC_INTERVAL = 4096
+
+    def __init__(self, n):
+        self.n = n
+        # Bins 1 .. n // 2 - 1, like features().
+        k = np.arange(1, n // 2)
+        self.twiddle = np.exp(2j * np.pi * k / n)
+        self.bins = np.zeros(len(k), dtype=complex)
+        # The averaged samples of the window, needed to remove the oldest one.
+        self.window = np.zeros(n)
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.n)
+
+    # Adds a sample of x, y, z values and slides the window by one.
+    def append(self, sample):
+        value = (float(sample[0]) + float(sample[1]) + float(sample[2])) / 3
+        pos = self.pos
+        oldest = self.window[pos]
+        self.window[pos] = value
+        self.pos = (pos + 1) % self.n
+        self.count += 1
+        if self.count % self.RESYNC_INTERVAL == 0:
+            self.resync()
+        else:
+            self.bins += value - oldest
+            self.bins *= self.twiddle
+
+    # Calculates the bins of the current window with a full FFT.
+    def resync(self):
+        ordered = np.roll(self.window, -self.pos)
+        self.bins = np.fft.fft(ordered)[1:self.n // 2]
+
+    def clear(self):
+        self.bins[:] = 0
+        self.window[:] = 0
+        self.pos = 0
+        self.count = 0
+
+    # Returns the magnitude spectrum of the window like features().
+    def features(self):
+        return np.abs(self.bins) / self.n
+
+
+class ActivityModel():
+
+    """
+    ActivityModel prepares the training samples, trains the SVM
+    and saves it together with its metadata in a model file.
+    All devices share one instance, see get_instance.
+    """
+
+    MODEL_FILE = "activity.model"
+
+    # Needs to be increased, when the stored model changes.
+    MODEL_VERSION = 2
+
+    # Needs to be increased, when the feature calculation changes.
+    FEATURE_VERSION = 2
+
+    # Training data: one directory per activity containing its csv recordings.
+    # The manifest lists the activities in the order of their labels,
+    # activities missing in it get the following labels in alphabetical order.
+    TRAINING_DIR = "training"
+    MANIFEST_FILE = "manifest.json"
+
+    # Maximum amount of folds of the cross-validation.
+    CV_FOLDS = 5
+
+    # Amount of threads reading the training files.
+    LOADER_THREADS = 8
+
+    # The shared instance.
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.c = svm.SVC(gamma=0.001, C=100, degree=3)
+        self.min_len = 0
+        self.classes = []
+        self.training_data = []
+        self.categories = []
+        self.meta = {}
+        self.lock = threading.Lock()
+
+    # Returns the model, which is shared by all devices.
+    # It is loaded or trained by the first caller only.
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls.load_or_train()
+        return cls._instance
+
+    # Loads the model file. If it does not exist or the training files
+    # have changed, the model will be trained and saved again.
+    @classmethod
+    def load_or_train(cls, filename=MODEL_FILE):
+        model = cls.load(filename)
+        if model is None:
+            model = cls()
+            model.train()
+            model.save(filename)
+        return model
+
+    # Returns the stored model or None, if it is missing or outdated.
+    @classmethod
+    def load(cls, filename=MODEL_FILE):
+        if not os.access(filename, os.F_OK):
+            return None
+        try:
+            with open(filename, "rb") as f:
+                stored = pickle.load(f)
+            meta = stored["meta"]
+            if meta["model_version"] != cls.MODEL_VERSION or \
+               meta["feature_version"] != cls.FEATURE_VERSION or \
+               meta["sources"] != cls.source_hashes():
+                return None
+            model = cls()
+            model.c = stored["classifier"]
+            model.training_data = stored["training_data"]
+            model.categories = stored["categories"]
+            model.classes = meta["classes"]
+            model.min_len = meta["min_len"]
+            model.meta = meta
+            return model
+        except Exception as e:
+            print("Could not load activity model: " + str(e))
+            return None
+
+    def save(self, filename=MODEL_FILE):
+        stored = {"meta": self.meta,
+                  "classifier": self.c,
+                  "training_data": self.training_data,
+                  "categories": self.categories}
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            pickle.dump(stored, f)
+        os.replace(tmp_filename, filename)
+
+    # Finds the training files.
+    # Returns the activity names in label order and per activity its csv files.
+    @classmethod
+    def discover(cls, directory=TRAINING_DIR):
+        order = []
+        manifest = os.path.join(directory, cls.MANIFEST_FILE)
+        if os.access(manifest, os.F_OK):
+            with open(manifest, "r") as f:
+                order = json.load(f).get("classes", [])
+        found = sorted(name for name in os.listdir(directory)
+                       if os.path.isdir(os.path.join(directory, name)))
+        classes = [name for name in order if name in found]
+        classes += [name for name in found if name not in classes]
+        sources = []
+        for name in classes:
+            class_dir = os.path.join(directory, name)
+            sources.append(sorted(os.path.join(class_dir, filename)
+                                  for filename in os.listdir(class_dir)
+                                  if filename.endswith(".csv")))
+        return classes, sources
+
+    # Hashes of the manifest and all training files.
+    @classmethod
+    def source_hashes(cls, directory=TRAINING_DIR):
+        classes, sources = cls.discover(directory)
+        filenames = [filename for files in sources for filename in files]
+        manifest = os.path.join(directory, cls.MANIFEST_FILE)
+        if os.access(manifest, os.F_OK):
+            filenames.append(manifest)
+        with ThreadPoolExecutor(cls.LOADER_THREADS) as executor:
+            hashes = executor.map(cls.hash_file, filenames)
+        return dict(zip(filenames, hashes))
+
+    @staticmethod
+    def hash_file(filename):
+        with open(filename, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def train(self, directory=TRAINING_DIR):
+        start = time.time()
+        self.buffer(directory)
+        training_time = time.time() - start
+        self.meta = {"model_version": self.MODEL_VERSION,
+                     "feature_version": self.FEATURE_VERSION,
+                     "min_len": self.min_len,
+                     "classes": self.classes,
+                     "recordings": len(self.categories),
+                     "sources": self.source_hashes(directory),
+                     "trained": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "training_time": training_time,
+                     "cv_accuracy": self.cross_validate()}
+
+    # Thread-safe prediction, the devices call it from their own threads.
+    def predict(self, feature_vector):
+        with self.lock:
+            return self.c.predict([feature_vector])
+
+    # Returns the name of the activity of a label.
+    def label_name(self, label):
+        if 0 <= label < len(self.classes):
+            return self.classes[label]
+        return None
+
+    def buffer(self, directory=TRAINING_DIR):
+        # Preparing samples for SVM.
+        # Reading in the recordings of all activities in parallel.
+        self.classes, sources = self.discover(directory)
+        filenames = [filename for files in sources for filename in files]
+        if len(filenames) == 0:
+            raise ValueError("no training files found in " + directory)
+        with ThreadPoolExecutor(self.LOADER_THREADS) as executor:
+            recordings = list(executor.map(load_samples, filenames))
+        # Cutting off all samples to the same length.
+        self.min_len = min(len(r) for r in recordings)
+        windows = np.stack([r[:self.min_len] for r in recordings])
+        # FFT Filter for all samples at once.
+        training_data = list(features(windows))
+        categories = [label for label, files in enumerate(sources)
+                      for _ in files]
+        # SVM.
+        self.svm(training_data, categories)
+
+    def svm(self, training_data, categories):
+        # Support Vector Machine.
+        self.c.fit(training_data, categories)
+        self.training_data = training_data
+        self.categories = categories
+
+    # Returns the mean accuracy of a stratified cross-validation
+    # or None, if an activity has less than two recordings.
+    def cross_validate(self):
+        counts = np.bincount(self.categories)
+        folds = min(self.CV_FOLDS, counts.min())
+        if len(counts) < 2 or folds < 2:
+            return None
+        scores = cross_val_score(svm.SVC(**self.c.get_params()),
+                                 np.array(self.training_data), self.categories,
+                                 cv=StratifiedKFold(folds))
+        return float(scores.mean())
 
 
 class ActivityRecognizer():
@@ -22,27 +356,56 @@ class ActivityRecognizer():
     predicting samples and manages activities/gestures.
     """
 
+    # Amount of accelerometer samples kept in memory (100 Hz).
+    BUFFER_SIZE = 1024
+
+    # Rate of the background classification in Hz.
+    UPDATE_RATE = 20
+
+    # Maximum age of the cached activity in seconds.
+    # If it is older, is_violin classifies the current samples itself.
+    MAX_STALENESS = 0.25
+
+    # Feature extraction: FFT of the latest window per prediction
+    # or a sliding DFT, which is updated with every sample.
+    SPECTRUM_BATCH = "batch"
+    SPECTRUM_SLIDING = "sliding"
+
+    # Name of the violin activity in the training data.
+    VIOLIN = "violin"
+
     # Initializes wiimote instance, activity recognizer and click callbacks.
-    def __init__(self, device):
+    def __init__(self, device, spectrum=SPECTRUM_BATCH):
         self.wm = device.wm
         self.device = device
+        self.spectrum = spectrum
         self.activity_recognizer()
         self.device.register_click_callback(self.on_click)
 
-    def is_violin(self):
+    def is_violin(self, max_staleness=MAX_STALENESS):
         # Check if current activity is violin.
-        self.check_activity()
-        if self.check_activity()[0] == 0:
+        current_act = self.get_activity(max_staleness)
+        if current_act is not None and \
+           self.model.label_name(current_act[0]) == self.VIOLIN:
             return True
         return False
 
+    def get_activity(self, max_staleness=None):
+        # Returns the latest activity of the background classification.
+        # If max_staleness is given and the activity is older, it is classified now.
+        current_act, timestamp = self.activity
+        if max_staleness is not None and \
+           (current_act is None or time.monotonic() - timestamp > max_staleness):
+            current_act = self.check_activity()
+        return current_act
+
     def check_activity(self):
-        # Check current activity in svm; Refreshing csv file.
+        # Check current activity in svm.
+        current_act = None
         try:
             current_act = self.buffer_act()
         except Exception as e:
             print(e)
-        self.refresh_csv()
         return current_act
 
     def on_click(self, btn, is_down):
@@ -53,154 +416,109 @@ class ActivityRecognizer():
             if btn == self.device.BTN_TWO:
                 self.status = 0
 
-    def write_csv(self):
-        # Writing csv file.
-        with open("act.csv", "w", newline="") as f:
-            writer = csv.writer(f)
+    def start_csv_dump(self, filename="act.csv", interval=1.0):
+        # Debugging: writes the buffered samples into a csv file
+        # every interval seconds in a background thread.
+        def dump():
+            while not self.dump_stop.wait(interval):
+                self.samples.to_csv(filename)
+        self.stop_csv_dump()
+        self.dump_stop = threading.Event()
+        self.dump_thread = threading.Thread(target=dump, daemon=True)
+        self.dump_thread.start()
 
-    def refresh_csv(self):
-        # Refreshing csv file, deleting old values.
-        if self.counter == 10:
-            with open("act.csv", "r") as f:
-                reader = csv.reader(f)
-                backup = list(reader)
-                len_backup = len(backup)
-                diff = int(len_backup / 2)
-            with open("act.csv", "w", newline="") as f:
-                writer = csv.writer(f)
-                for x in range(diff, len_backup):
-                    writer.writerow([backup[x][0], backup[x][1], backup[x][2]])
-                self.counter = 0
-        self.counter += 1
-
-    def add_csv(self, vals):
-        # Adding accelerometer values to csv file.
-        with open("act.csv", "a", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([vals[0], vals[1], vals[2]])
-
-    def read_csv(self, filename):
-        # Reading CSV Files.
-        with open(filename, "r") as f:
-            reader = csv.reader(f)
-            activity_vals = list(reader)
-            return activity_vals
+    def stop_csv_dump(self):
+        if self.dump_thread is not None:
+            self.dump_stop.set()
+            self.dump_thread = None
 
     def buffer_act(self):
-        # This function reads in the current activity values and compares them with the trained SVM.
-        act = self.read_csv("act.csv")
-        act_vals = [act]
-        act = self.avg(act_vals)
-        act = [l[-self.min_len:] for l in act]
-        act_freq = self.fft(act)
-        self.current_activity = self.c.predict([act_freq[0]])
+        # This function takes the latest accelerometer values and compares them with the trained SVM.
+        if self.spectrum == self.SPECTRUM_SLIDING:
+            if len(self.sliding) < self.min_len:
+                return None
+            feature_vector = self.sliding.features()
+        else:
+            if len(self.samples) < self.min_len:
+                return None
+            feature_vector = features(self.samples.latest(self.min_len))
+        self.current_activity = self.model.predict(feature_vector)
+        # Publishing the activity with its timestamp in one assignment.
+        self.activity = (self.current_activity, time.monotonic())
         return self.current_activity
 
-    def buffer(self):
-        # Preparing samples for SVM.
-        # Reading in violin samples.
-        vio_one = self.read_csv("vio.csv")
-        vio_two = self.read_csv("vio2.csv")
-        vio_three = self.read_csv("vio3.csv")
-        vio_four = self.read_csv("vio4.csv")
-        vio_vals = [vio_one, vio_two, vio_three, vio_four]
-        # Reading in guitar samples.
-        guitar_one = self.read_csv("guitar.csv")
-        guitar_two = self.read_csv("guitar2.csv")
-        guitar_three = self.read_csv("guitar3.csv")
-        guitar_four = self.read_csv("guitar4.csv")
-        guitar_vals = [guitar_one, guitar_two, guitar_three, guitar_four]
-        # Reading in drums samples.
-        drums_one = self.read_csv("drums.csv")
-        drums_two = self.read_csv("drums2.csv")
-        drums_three = self.read_csv("drums3.csv")
-        drums_four = self.read_csv("drums4.csv")
-        drums_vals = [drums_one, drums_two, drums_three, drums_four]
-        # Calculating average for all samples.
-        vio = self.avg(vio_vals)
-        guitar = self.avg(guitar_vals)
-        drums = self.avg(drums_vals)
-        # Cutting off all samples to the same length.
-        vio, guitar, drums = self.cut_off(vio, guitar, drums)
-        # FFT Filter.
-        vio_freq = self.fft(vio)
-        guitar_freq = self.fft(guitar)
-        drums_freq = self.fft(drums)
-        # SVM.
-        self.svm(vio_freq, guitar_freq, drums_freq)
-
-    def avg(self, data):
-        # This function calculates average values for a sample.
-        buffered_vals = []
-        for f in data:
-            x = []
-            y = []
-            z = []
-            avg = []
-            for line in f:
-                _x = int(line[0])
-                _y = int(line[1])
-                _z = int(line[2])
-                x.append(_x)
-                y.append(_y)
-                z.append(_z)
-                avg.append((_x + _y + _z) / 3)
-            buffered_vals.append(avg)
-        return buffered_vals
-
-    def cut_off(self, vio, guitar, drums):
-        # This function cuts off samples to the same length.
-        all_vals = vio + guitar + drums
-        self.min_len = min([len(x) for x in all_vals])
-        vio = [l[:self.min_len] for l in vio]
-        guitar = [l[:self.min_len] for l in guitar]
-        drums = [l[:self.min_len] for l in drums]
-        return vio, guitar, drums
-
     def activity_recognizer(self):
         # This function initializes the activity recognizer.
-        self.c = svm.SVC(gamma=0.001, C=100, degree=3)
-        self.counter = 0
-        self.min_len = 0
-        self.write_csv()
+        # The SVM is shared by all devices, each device only keeps its own samples.
+        self.model = ActivityModel.get_instance()
+        self.min_len = self.model.min_len
+        self.samples = RingBuffer(self.BUFFER_SIZE)
+        self.sliding = SlidingSpectrum(self.min_len)
+        self.dump_thread = None
         self.status = 0
         self.acc_vals = []
-        # Preparing all samples for SVM.
-        self.buffer()
-        self.update_timer = QtCore.QTimer()
-        self.update_timer.timeout.connect(self.update_all_sensors)
+        self.activity = (None, 0)
+        self.classified_total = 0
+        self.update_stop = threading.Event()
+        self.update_thread = None
         self.set_update_rate()
 
+    def set_spectrum(self, spectrum):
+        # Switches the feature extraction, the sliding DFT starts with the buffered samples.
+        if spectrum == self.SPECTRUM_SLIDING and self.spectrum != spectrum:
+            self.sliding.clear()
+            for sample in self.samples.latest(self.min_len):
+                self.sliding.append(sample)
+        self.spectrum = spectrum
+
     def update_all_sensors(self):
-        # Sensor Update.
+        # Sensor Update: classifies the samples, if new ones arrived.
         if self.wm is None:
             return
+        total = self.samples.total
+        if total != self.classified_total:
+            self.classified_total = total
+            self.check_activity()
 
     def set_update_rate(self):
-        # Update timer for accelerometer output.
+        # Update thread for the classification of the accelerometer output.
+        # Qt timers can not be used, as the devices are created outside of the Qt thread.
         self.wm.accelerometer.register_callback(self.update_accel)
-        self.update_timer.start(1000.0 / 20)
+        self.update_thread = threading.Thread(target=self.run_updates, daemon=True)
+        self.update_thread.start()
+
+    def run_updates(self):
+        interval = 1.0 / self.UPDATE_RATE
+        next_update = time.monotonic()
+        while not self.update_stop.is_set():
+            self.update_all_sensors()
+            next_update += interval
+            self.update_stop.wait(max(0, next_update - time.monotonic()))
+
+    def stop(self):
+        # Stops the background classification.
+        self.update_stop.set()
 
     def update_accel(self, acc_vals):
         # Update accelerometer values.
-        self.acc_vals = self.wm.accelerometer
+        self.acc_vals = acc_vals
         if self.status == 0:
-            self.add_csv(self.acc_vals)
-
-    def fft(self, data):
-        # Fast Fourier Transformation.
-        data_freq = []
-        for l in data:
-            n = len(l)
-            frq = np.abs(fft(l)/n)[1:n//2]
-            data_freq.append(frq)
-        return data_freq
-
-    def svm(self, vio_freq, guitar_freq, drums_freq):
-        # Support Vector Machine.
-        vio = 0
-        guitar = 1
-        drums = 2
-        categories = [vio] * 3 + [guitar] * 3 + [drums] * 3
-        training_data = vio_freq[1:] + guitar_freq[1:] + drums_freq[1:]
-        self.c.fit(training_data, categories)
+            self.samples.append(acc_vals)
+            if self.spectrum == self.SPECTRUM_SLIDING:
+                self.sliding.append(acc_vals)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "train":
+        model = ActivityModel()
+        model.train()
+        model.save()
+        print("Trained activity model (min_len %d) in %.3f s, saved to %s." %
+              (model.min_len, model.meta["training_time"], ActivityModel.MODEL_FILE))
+        print("Activities: %s, %d recordings" %
+              (", ".join(model.classes), model.meta["recordings"]))
+        accuracy = model.meta["cv_accuracy"]
+        if accuracy is not None:
+            print("Cross-validated accuracy: %.1f%%" % (accuracy * 100))
+    else:
+        print("Usage: python3 activity_recognizer.py train")
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+The Benchmark module measures the speed and the accuracy of the Recognizer.
+It generates perturbed unistrokes out of the templates in strokes.map
+(noise, scaling, rotation and varying point counts), recognizes them with
+each engine and mode and writes the results as JSON, so that runs can be
+compared over time.
+
+Usage: python3 benchmark.py [--strokes 200] [--seed 1] [--output benchmark.json]
+                            [--keep-going]
+A failing stroke stops the benchmark, unless --keep-going is given.
+Then the failures are counted per exception in the results.
+
+Authors: Thomas Oswald, Paul Winderl
+"""
+
+import argparse
+import json
+import math
+import platform
+import time
+
+import numpy as np
+
+from recognizer import Recognizer
+from templates import TemplateStore
+
+STAGES = ["resample", "rotate_to_zero", "scale_to_square",
+          "translate_to_origin", "compare"]
+
+CONFIGS = [(Recognizer.ENGINE_PYTHON, Recognizer.MODE_GOLDEN_SECTION),
+           (Recognizer.ENGINE_PYTHON, Recognizer.MODE_PROTRACTOR),
+           (Recognizer.ENGINE_NUMPY, Recognizer.MODE_GOLDEN_SECTION),
+           (Recognizer.ENGINE_NUMPY, Recognizer.MODE_PROTRACTOR)]
+
+
+# Creates a perturbed copy of a template.
+# The template path is resampled to a random point count, rotated,
+# scaled, moved and each point gets gaussian noise.
+def perturb(points, rng, noise, max_rotation, min_points, max_points):
+    points = np.asarray(points, dtype=float)
+    count = int(rng.integers(min_points, max_points + 1))
+    lengths = np.concatenate(
+        ([0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))))
+    targets = np.linspace(0, lengths[-1], count)
+    stroke = np.stack((np.interp(targets, lengths, points[:, 0]),
+                       np.interp(targets, lengths, points[:, 1])), axis=-1)
+    radian = rng.uniform(-max_rotation, max_rotation)
+    rotation = np.array([[math.cos(radian), math.sin(radian)],
+                         [-math.sin(radian), math.cos(radian)]])
+    stroke = stroke @ rotation
+    stroke = stroke * rng.uniform(0.5, 3.0, size=2)
+    stroke = stroke + rng.uniform(0, 500, size=2)
+    stroke = stroke + rng.normal(0, noise, size=stroke.shape)
+    return [tuple(point) for point in stroke.tolist()]
+
+
+# Generates the test strokes as (template name, points) tuples.
+def generate(store, amount, seed, noise, max_rotation, min_points, max_points):
+    rng = np.random.default_rng(seed)
+    names = store.names()
+    templates = [(name, points) for name in names for points in store.get(name)]
+    strokes = []
+    for _ in range(amount):
+        name, points = templates[int(rng.integers(len(templates)))]
+        strokes.append((name, perturb(points, rng, noise, max_rotation,
+                                      min_points, max_points)))
+    return strokes
+
+
+# Recognizes a stroke stage by stage like Recognizer.recognize.
+# The stroke is classified by the best score over all template names.
+# Returns the recognized name and the durations of the stages in seconds.
+def run_stroke(rec, points, names):
+    if rec.engine == Recognizer.ENGINE_NUMPY:
+        stages = [rec.rotate_to_zero_np,
+                  lambda p: rec.scale_to_square_np(p, 100),
+                  rec.translate_to_origin_np]
+    else:
+        stages = [lambda p: rec.rotate_to_zero(p.tolist()),
+                  lambda p: rec.scale_to_square(p, 100),
+                  rec.translate_to_origin]
+    durations = []
+    t = time.perf_counter()
+    points = rec.resample(points)
+    durations.append(time.perf_counter() - t)
+    for stage in stages:
+        t = time.perf_counter()
+        points = stage(points)
+        durations.append(time.perf_counter() - t)
+    t = time.perf_counter()
+    best = None
+    for name in names:
+        result = rec.match(points, name, 100)
+        if result is not None and (best is None or result[1] > best[1]):
+            best = (name, result[1])
+    durations.append(time.perf_counter() - t)
+    return best[0] if best is not None else None, durations
+
+
+def summarize(values):
+    values = np.asarray(values) * 1000
+    return {"mean_ms": float(values.mean()),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p99_ms": float(np.percentile(values, 99))}
+
+
+def benchmark(strokes, names, engine, mode, store, keep_going=False):
+    rec = Recognizer(store=store, engine=engine, mode=mode)
+    stage_times = [[] for _ in STAGES]
+    totals = []
+    correct = 0
+    errors = {}
+    start = time.perf_counter()
+    for name, points in strokes:
+        try:
+            recognized, durations = run_stroke(rec, points, names)
+        except Exception as e:
+            if not keep_going:
+                raise
+            error = "%s: %s" % (type(e).__name__, e)
+            errors[error] = errors.get(error, 0) + 1
+            continue
+        for idx, duration in enumerate(durations):
+            stage_times[idx].append(duration)
+        totals.append(sum(durations))
+        if recognized == name:
+            correct += 1
+    elapsed = time.perf_counter() - start
+    result = {"engine": engine,
+              "mode": mode,
+              "strokes": len(strokes),
+              "errors": sum(errors.values()),
+              "error_types": errors,
+              "throughput_per_s": len(totals) / elapsed if elapsed > 0 else 0,
+              "top1_accuracy": correct / len(strokes) if strokes else 0,
+              "stats": dict(rec.stats)}
+    if len(totals) > 0:
+        result["total"] = summarize(totals)
+        result["stages"] = {stage: summarize(times)
+                            for stage, times in zip(STAGES, stage_times)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recognizer benchmark")
+    parser.add_argument("--templates", default=None,
+                        help="template file (default: strokes.bin or strokes.map)")
+    parser.add_argument("--strokes", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--noise", type=float, default=2.0)
+    parser.add_argument("--rotation", type=float, default=30.0,
+                        help="maximum rotation in degrees")
+    parser.add_argument("--min-points", type=int, default=16)
+    parser.add_argument("--max-points", type=int, default=256)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--keep-going", action="store_true",
+                        help="count failing strokes instead of stopping")
+    args = parser.parse_args()
+
+    store = TemplateStore.get_store(args.templates)
+    names = store.names()
+    strokes = generate(store, args.strokes, args.seed, args.noise,
+                       math.radians(args.rotation), args.min_points,
+                       args.max_points)
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "templates": store.path,
+              "template_count": len(store),
+              "settings": vars(args),
+              "results": []}
+    for engine, mode in CONFIGS:
+        result = benchmark(strokes, names, engine, mode, store, args.keep_going)
+        report["results"].append(result)
+        total = result.get("total", {})
+        print("%-7s %-15s %8.1f strokes/s  p50 %7.3f ms  p99 %7.3f ms  "
+              "top-1 %5.1f%%  errors %d" %
+              (engine, mode, result["throughput_per_s"],
+               total.get("p50_ms", 0), total.get("p99_ms", 0),
+               result["top1_accuracy"] * 100, result["errors"]))
+        for error, count in result["error_types"].items():
+            print("    %dx %s" % (count, error))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
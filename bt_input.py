@@ -10,12 +10,180 @@ Author: Thomas Oswald
 Adjustments by: Paul Winderl
 """
 
+import math
+import threading
+import time
+from collections import deque
+import numpy as np
 import wiimote
+from emulator import Emulator
 from transform import Transform
 from activity_recognizer import ActivityRecognizer
 from bluetooth import BluetoothError
 
 
+class ReportQueue:
+
+    """
+    The ReportQueue passes the reports of a Wiimote from the bluetooth thread
+    to the thread consuming them, so that slow consumers do not stall the
+    reception. A new IR frame replaces a pending one, as only the latest one matters.
+    It is bounded: when it is full, the oldest IR frame is dropped.
+    Button reports are never dropped, so no clicks get lost.
+    """
+
+    KIND_BUTTONS = 0
+    KIND_IR = 1
+
+    # Kinds of which only the latest report is kept.
+    COALESCED = (KIND_IR,)
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        self.reports = deque()
+        # The queued reports, which can still be replaced, per kind.
+        self.pending = {}
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.reports)
+
+    # Adds a report, called by the bluetooth thread.
+    def put(self, kind, data):
+        with self.lock:
+            self.received += 1
+            if kind in self.COALESCED:
+                entry = self.pending.get(kind)
+                if entry is not None:
+                    entry[1] = data
+                    self.coalesced += 1
+                    return
+            else:
+                # Later frames must not be moved in front of this report.
+                self.pending.clear()
+            if len(self.reports) >= self.maxlen and not self.__drop_oldest__():
+                if kind in self.COALESCED:
+                    self.dropped += 1
+                    return
+            entry = [kind, data]
+            self.reports.append(entry)
+            if kind in self.COALESCED:
+                self.pending[kind] = entry
+
+    # Drops the oldest coalescible report. Returns False, if there is none.
+    def __drop_oldest__(self):
+        for idx, entry in enumerate(self.reports):
+            if entry[0] in self.COALESCED:
+                del self.reports[idx]
+                if self.pending.get(entry[0]) is entry:
+                    del self.pending[entry[0]]
+                self.dropped += 1
+                return True
+        return False
+
+    # Drops all queued reports, e.g. when the consumer changes.
+    def clear(self):
+        with self.lock:
+            self.reports = deque()
+            self.pending = {}
+
+    # Removes and returns all queued reports as [kind, data] lists, oldest first.
+    def get_all(self):
+        with self.lock:
+            reports = self.reports
+            self.reports = deque()
+            self.pending = {}
+        return reports
+
+    def stats(self):
+        return {"received": self.received,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "queued": len(self.reports)}
+
+
+class PointFilter:
+
+    """
+    The PointFilter smooths the four IR points of every frame before the projection
+    and returns the filtered points on every frame.
+    MOVING_AVERAGE: mean of the last frames, kept as running sum of a fixed ring.
+    EXPONENTIAL: exponential smoothing, which follows movements with less lag.
+    ONE_EURO: the One Euro filter (Casiez et al. 2012), which smooths strongly,
+    when the Wiimote is held still, and little, when it is moved fast.
+    """
+
+    MOVING_AVERAGE = "moving_average"
+    EXPONENTIAL = "exponential"
+    ONE_EURO = "one_euro"
+
+    # Report rate of the Wiimote, used when frames have no timestamps.
+    RATE = 100
+
+    def __init__(self, mode=MOVING_AVERAGE, size=20, alpha=0.3,
+                 min_cutoff=1.0, beta=0.01, d_cutoff=1.0):
+        if mode not in (self.MOVING_AVERAGE, self.EXPONENTIAL, self.ONE_EURO):
+            raise ValueError("Unknown filter mode: " + str(mode))
+        self.mode = mode
+        self.size = size
+        self.alpha = alpha
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.ring = np.zeros((size, 4, 2))
+        self.sum = np.zeros((4, 2))
+        self.reset()
+
+    def reset(self):
+        self.pos = 0
+        self.count = 0
+        self.sum[:] = 0
+        self.value = None
+        self.derivative = None
+        self.timestamp = None
+
+    # Adds the four (x, y) points of a frame and returns the filtered points as (4, 2) array.
+    def add(self, points, timestamp=None):
+        frame = np.asarray(points, dtype=float)
+        if self.mode == self.MOVING_AVERAGE:
+            # The coordinates are integers, so the running sum does not drift.
+            if self.count == self.size:
+                self.sum -= self.ring[self.pos]
+            else:
+                self.count += 1
+            self.sum += frame
+            self.ring[self.pos] = frame
+            self.pos = (self.pos + 1) % self.size
+            return self.sum / self.count
+        if self.value is None:
+            self.value = frame
+            self.derivative = np.zeros_like(frame)
+            self.timestamp = timestamp
+            return self.value.copy()
+        if self.mode == self.EXPONENTIAL:
+            self.value += self.alpha * (frame - self.value)
+            return self.value.copy()
+        dt = 1.0 / self.RATE
+        if timestamp is not None and self.timestamp is not None and timestamp > self.timestamp:
+            dt = timestamp - self.timestamp
+        self.timestamp = timestamp
+        # The speed is smoothed itself and raises the cutoff frequency.
+        speed = (frame - self.value) / dt
+        self.derivative += self.smoothing(self.d_cutoff, dt) * (speed - self.derivative)
+        cutoff = self.min_cutoff + self.beta * np.abs(self.derivative)
+        self.value += self.smoothing(cutoff, dt) * (frame - self.value)
+        return self.value.copy()
+
+    # Smoothing factor of a low-pass filter with the cutoff frequency in Hz.
+    @staticmethod
+    def smoothing(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+
 class Device:
 
     """
@@ -29,42 +197,65 @@ class Device:
     BTN_ONE = 3
     BTN_TWO = 4
 
-    # Moving average length
+    # Moving average length in camera frames
     MV_SIZE = 20
 
+    # Filter of the IR points, see PointFilter.
+    FILTER = PointFilter.MOVING_AVERAGE
+
+    # Maximum amount of reports waiting for poll.
+    QUEUE_SIZE = 64
+
     # At the initialization wiimote.py tries to connect to a hardware address.
-    def __init__(self, address):
+    # An already connected wiimote (e.g. the replay of a recorded session) can be passed as wm.
+    def __init__(self, address, wm=None):
         try:
             # This is for the lazy ones.
-            if address == "1":
+            if wm is not None:
+                self.wm = wm
+            elif address == "1":
                 self.wm = wiimote.connect("b8:ae:6e:1b:5a:a6")
                 # self.wm = wiimote.connect("b8:ae:6e:1b:ad:8c")
             elif address == "2":
                 self.wm = wiimote.connect("b8:ae:6e:ef:ef:d6")
                 # self.wm = wiimote.connect("b8:ae:6e:f1:39:81")
+            elif address.startswith(Emulator.PREFIX):
+                self.wm = wiimote.connect(address, socket_factory=Emulator.get_instance())
             else:
                 self.wm = wiimote.connect(address)
         except BluetoothError as e:
             print("BluetoothError: " + str(e))
             raise ValueError("No valid bluetooth address.")
 
-        self.wm.buttons.register_callback(self.__on_press__)
+        # The reports are queued by the bluetooth thread and handled in poll.
+        self.reports = ReportQueue(self.QUEUE_SIZE)
+        self.wm.buttons.register_callback(self.__queue_buttons__)
 
         self.move_callback = None
         self.click_callback = None
         self.gesture_btn_callback = None
         self.confirm_callback = None
         self.current_w_size = (500, 500)
-        self.points_arr = []
+        self.filter = PointFilter(self.FILTER, self.MV_SIZE)
 
         # Instantiate the activity recognizer.
+        start = time.perf_counter()
         self.ar = ActivityRecognizer(self)
+        # Durations of the connection phases in seconds.
+        self.timings = dict(getattr(self.wm, "timings", {}))
+        self.timings["model_load"] = time.perf_counter() - start
 
     def setLed(self, idx):
         if idx == 1:
             self.wm.leds[0] = False
         self.wm.leds[idx] = True
 
+    # Changes the filter of the pointing, e.g. set_filter(PointFilter.ONE_EURO).
+    # The parameters are passed to the PointFilter.
+    # The new filter replaces the old one as a whole, so it can be set from any thread.
+    def set_filter(self, mode, size=MV_SIZE, **params):
+        self.filter = PointFilter(mode, size, **params)
+
     # If it is necessary for the projective transformation, the destination widget size can be changed.
     def set_widget_size(self, size):
         self.current_w_size = size
@@ -73,27 +264,71 @@ class Device:
     # Everytime the Wiimote moves, this will print out the projected point on the destination widget.
     def register_move_callback(self, callback):
         self.move_callback = callback
+        self.reports.clear()
 
     # Registers a callback for the button input.
     def register_click_callback(self, callback):
         self.click_callback = callback
+        self.reports.clear()
 
     # Registers a callback for the player.
     # This is needed, because he needs to do a gesture before he is able to press a button.
     def register_gesture_btn_callback(self, callback):
         self.gesture_btn_callback = callback
+        self.reports.clear()
 
     # Registers a callback that does not have the same parameters as the click callback.
     # The difference is, that the confirmation will only trigger, when a button is pressed down
     # and not when it is released.
     def register_confirm_callback(self, callback):
         self.confirm_callback = callback
+        self.reports.clear()
 
+    # The reports queued so far were meant for the previous consumer,
+    # so they are dropped whenever the callbacks change.
     def unregister_callbacks(self):
         self.move_callback = None
         self.click_callback = None
         self.gesture_btn_callback = None
         self.confirm_callback = None
+        self.reports.clear()
+
+    # Handles the queued reports on the calling thread and calls the registered callbacks.
+    # It needs to be called regularly by the consumer, e.g. by a Qt timer or the game loop.
+    # Returns the amount of handled reports.
+    def poll(self):
+        reports = self.reports.get_all()
+        for kind, data in reports:
+            if kind == ReportQueue.KIND_BUTTONS:
+                self.__on_press__(data)
+            else:
+                self.__on_move__(data)
+        return len(reports)
+
+    # Returns the counters of the report queue.
+    def report_stats(self):
+        return self.reports.stats()
+
+    # The IR tracking is switched here on the bluetooth thread, so that no IR frames
+    # of the time between releasing A and the next poll spill into the next stroke.
+    def __queue_buttons__(self, objects):
+        if objects is not None and len(objects) > 0:
+            self.reports.put(ReportQueue.KIND_BUTTONS, objects)
+            for btn, is_down in objects:
+                if btn == 'A':
+                    if is_down and self.move_callback is not None:
+                        self.filter.reset()
+                        self.wm.ir.register_callback(self.__queue_ir__)
+                    else:
+                        self.wm.ir.unregister_callback(self.__queue_ir__)
+
+    # Every camera frame with all 4 leds is filtered here on the bluetooth thread,
+    # which is the only one using the filter state (it is reset in __queue_buttons__).
+    # Only the filtered points are queued, so skipped polls do not change the filter.
+    def __queue_ir__(self, data):
+        if len(data) == 4:
+            filtered = self.filter.add([(item.x, item.y) for item in data], time.monotonic())
+            self.reports.put(ReportQueue.KIND_IR, filtered.tolist())
 
     # on_press handles all button presses of a Wiimote and acts in a defined way.
     def __on_press__(self, objects):
@@ -102,13 +337,9 @@ class Device:
                 btn = btn_object[0]
                 is_down = btn_object[1]
                 found_btn = None
-                # Button hold for drawing gestures and signature
+                # Button hold for drawing gestures and signature,
+                # the IR tracking is switched in __queue_buttons__.
                 if btn == 'A':
-                    if is_down and self.move_callback is not None:
-                        self.points_arr = []
-                        self.wm.ir.register_callback(self.__on_move__)
-                    else:
-                        self.wm.ir.unregister_callback(self.__on_move__)
                     found_btn = self.BTN_A
                 # Button push for signature confirm and "B-Note" playing
                 elif btn == 'B':
@@ -131,27 +362,16 @@ class Device:
                     if self.click_callback is not None:
                         self.click_callback(found_btn, is_down)
 
-    # This method executes a projective transformation,
-    # when all 4 infrared light diodes are in the focus of the ir camera.
-    def __on_move__(self, data):
-        # Only accepts data that has all 4 leds
-        if len(data) == 4:
-            points = []
-            for item in data:
-                points.append((item['x'], item['y']))
-            self.points_arr.append(points)
-            del points
-            if len(self.points_arr) == self.MV_SIZE:
-                x, y = self.__project_points__(self.points_arr)
-                if self.move_callback is not None:
-                    self.move_callback(x, y)
-                self.points_arr = []
+    # This method executes a projective transformation of the latest filtered points
+    # of all 4 infrared light diodes.
+    def __on_move__(self, points):
+        x, y = self.__project_points__(points)
+        if self.move_callback is not None:
+            self.move_callback(x, y)
 
     # This function projects a point from the source projection
     # to the destination projection and returns the coordinate.
-    def __project_points__(self, array):
-
-        points = self.__mv_calc__(array)
+    def __project_points__(self, points):
         # P is the center point of the wiimote IR camera
         # DEST is the destination resolution
         P, DEST = (1024 / 2, 768 / 2), self.current_w_size
@@ -161,20 +381,3 @@ class Device:
         except Exception as e:
             x = y = -1
             return (x, y)
-
-    # This method calculates the mean over moving values.
-    # A simple moving average is used.
-    def __mv_calc__(self, values):
-        result = []
-        for idx in range(4):
-            x_arr = []
-            y_arr = []
-            for points in values:
-                point = points[idx]
-                x_arr.append(point[0])
-                y_arr.append(point[1])
-
-            x = sum(x_arr) / len(x_arr)
-            y = sum(y_arr) / len(y_arr)
-            result.append((x, y))
-        return result
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+The Emulator module emulates Wiimotes on local socket pairs, so that
+wiimote.py, the Devices and everything above them run without bluetooth.
+
+An emulated Wiimote speaks the report protocol of a real one: it follows
+the reporting mode (0x30, 0x31, 0x33), answers memory reads (0x21) and
+acknowledges memory writes (0x22). Its buttons, motion and IR points are
+taken from a trace, which is scripted, a recorded csv of accelerometer
+samples or a recorded session of session.py.
+
+Devices with an address starting with "emu" are connected to the shared
+emulator, e.g.: python3 system_demo.py emu1 emu2
+
+Load test: python3 emulator.py [--controllers 10] [--rate 100] [--duration 5]
+
+Author: Thomas Oswald
+"""
+
+import argparse
+import bisect
+import csv
+import heapq
+import selectors
+import socket
+import threading
+import time
+
+import wiimote
+
+
+INPUT_PREFIX = 0xa1
+
+MODE_BUTTONS = 0x30
+MODE_ACC = 0x31
+MODE_ACC_IR = 0x33
+
+
+def encode_report(mode, buttons, accel, ir):
+    """
+    Encodes the state of a Wiimote into an input report of the given mode.
+    buttons: button word, see wiimote.Buttons.BUTTONS
+    accel: x, y, z values between 0 and 1023
+    ir: up to 4 (x, y) points between (0, 0) and (1023, 767)
+    """
+    x, y, z = accel
+    # The least significant bits of the accelerometer are part of the button bytes.
+    report = [INPUT_PREFIX, mode,
+              (buttons >> 8) | ((x & 0b11) << 5),
+              (buttons & 0xff) | ((y & 0b10) << 4) | ((z & 0b10) << 5)]
+    if mode == MODE_BUTTONS:
+        return bytes(report)
+    report += [x >> 2, y >> 2, z >> 2]
+    if mode == MODE_ACC:
+        return bytes(report)
+    for idx in range(4):
+        if idx < len(ir):
+            ir_x, ir_y = int(ir[idx][0]), int(ir[idx][1])
+            report += [ir_x & 0xff, ir_y & 0xff,
+                       ((ir_y >> 8) << 6) | ((ir_x >> 8) << 4) | 0x02]
+        else:
+            report += [0xff, 0xff, 0xff]  # not visible
+    return bytes(report)
+
+
+def button_word(names):
+    """
+    Returns the button word of the pressed buttons given by their names.
+    """
+    word = 0
+    for name in names:
+        word |= wiimote.Buttons.BUTTONS[name]
+    return word
+
+
+class Trace(object):
+    """
+    An idle Wiimote: no button is pressed, it lies still
+    and sees four IR leds in a rectangle.
+    """
+
+    ACCEL_REST = (512, 512, 616)
+    IR_POINTS = [(312, 234), (712, 234), (712, 534), (312, 534)]
+
+    # Returns the button word, the accelerometer values and the IR points at time t.
+    def state(self, t):
+        return 0, self.ACCEL_REST, self.IR_POINTS
+
+    # Returns the report at time t in seconds since the connection.
+    def report(self, t, mode):
+        return encode_report(mode, *self.state(t))
+
+
+class ScriptedTrace(Trace):
+    """
+    A scripted Wiimote.
+    buttons: list of (time, button name, pressed) events
+    accel, ir: constant values or functions of the time
+    duration: the script is repeated after this many seconds, if given
+    """
+
+    def __init__(self, buttons=(), accel=None, ir=None, duration=None):
+        events = sorted(buttons, key=lambda event: event[0])
+        self.times = [event[0] for event in events]
+        self.words = []
+        word = 0
+        for _, name, pressed in events:
+            mask = wiimote.Buttons.BUTTONS[name]
+            word = word | mask if pressed else word & ~mask
+            self.words.append(word)
+        self.accel = accel if accel is not None else self.ACCEL_REST
+        self.ir = ir if ir is not None else self.IR_POINTS
+        self.duration = duration
+
+    def state(self, t):
+        if self.duration is not None:
+            t %= self.duration
+        idx = bisect.bisect_right(self.times, t)
+        word = self.words[idx - 1] if idx > 0 else 0
+        accel = self.accel(t) if callable(self.accel) else self.accel
+        ir = self.ir(t) if callable(self.ir) else self.ir
+        return word, accel, ir
+
+
+class CsvTrace(Trace):
+    """
+    Replays recorded accelerometer samples (x, y, z per line) in a loop,
+    e.g. the activity training files.
+    """
+
+    def __init__(self, filename, sample_rate=100):
+        with open(filename, "r") as f:
+            self.samples = [tuple(int(v) for v in row) for row in csv.reader(f) if len(row) == 3]
+        if len(self.samples) == 0:
+            raise ValueError("no samples in " + filename)
+        self.sample_rate = sample_rate
+
+    def state(self, t):
+        sample = self.samples[int(t * self.sample_rate) % len(self.samples)]
+        return 0, sample, self.IR_POINTS
+
+
+class SessionTrace(Trace):
+    """
+    Replays the reports of a session recorded with session.py in a loop.
+    The recorded reports are sent as they are, regardless of the mode.
+    """
+
+    def __init__(self, filename):
+        # Imported here, as session.py depends on the Devices.
+        from session import SessionRecorder
+        _, records = SessionRecorder.read(filename)
+        reports = [(t, payload) for t, kind, payload in records
+                   if kind == SessionRecorder.KIND_REPORT and len(payload) > 0 and
+                   payload[0] not in wiimote.Memory.SUPPORTED_REPORTS]
+        if len(reports) == 0:
+            raise ValueError("no reports in " + filename)
+        self.times = [t for t, _ in reports]
+        self.reports = [bytes([INPUT_PREFIX]) + payload for _, payload in reports]
+        self.duration = self.times[-1] + 0.01
+
+    def report(self, t, mode):
+        idx = bisect.bisect_right(self.times, t % self.duration)
+        return self.reports[max(idx - 1, 0)]
+
+
+class EmulatedWiimote(object):
+    """
+    The emulated side of one connection.
+    """
+
+    MAX_EEPROM = wiimote.Memory.MAX_ADDRESS
+
+    def __init__(self, address, control, data, trace, rate):
+        self.address = address
+        self.control = control
+        self.data = data
+        self.trace = trace
+        self.interval = 1.0 / rate
+        self.mode = MODE_BUTTONS
+        self.eeprom = bytearray(self.MAX_EEPROM + 1)
+        self.registers = {}
+        self.start = time.monotonic()
+        self.next_report = self.start
+        self.last_report = None
+        self.connected = True
+        self.sent = 0
+        # Reports, which did not fit into the socket buffer.
+        self.dropped = 0
+        # A slow reader must not block the other emulated Wiimotes.
+        self.data.setblocking(False)
+
+    # Sends the report of the current time, returns the time of the next one.
+    def send_report(self, now):
+        report = self.trace.report(now - self.start, self.mode)
+        # Like a real Wiimote, the button mode only reports changes.
+        if self.mode != MODE_BUTTONS or report != self.last_report:
+            self.send(report)
+        self.last_report = report
+        self.next_report += self.interval
+        if self.next_report < now:  # fell behind, skipping reports
+            self.next_report = now + self.interval
+        return self.next_report
+
+    def send(self, report):
+        try:
+            self.data.send(report)
+            self.sent += 1
+        except BlockingIOError:
+            self.dropped += 1
+        except OSError:
+            self.connected = False
+
+    # Handles an output report sent by wiimote.py.
+    def handle_command(self, msg):
+        if len(msg) < 3:
+            return
+        rpt = msg[1]
+        if rpt == 0x12 and len(msg) >= 4:
+            self.mode = msg[3]
+        elif rpt == wiimote.Memory.RPT_WRITE and len(msg) >= 7:
+            self.write(msg)
+        elif rpt == wiimote.Memory.RPT_READ and len(msg) >= 8:
+            self.read(msg)
+
+    def write(self, msg):
+        eeprom = (msg[2] & 0x04) == 0
+        address = int.from_bytes(msg[3:6], "big")
+        size = msg[6]
+        error = 0
+        if eeprom:
+            if address + size > self.MAX_EEPROM:
+                error = 8
+            else:
+                self.eeprom[address:address + size] = msg[7:7 + size]
+        else:
+            for idx in range(size):
+                self.registers[address + idx] = msg[7 + idx]
+        self.send(bytes([INPUT_PREFIX, 0x22, 0, 0, wiimote.Memory.RPT_WRITE, error]))
+
+    def read(self, msg):
+        eeprom = (msg[2] & 0x04) == 0
+        address = int.from_bytes(msg[3:6], "big")
+        amount = int.from_bytes(msg[6:8], "big")
+        if eeprom and address + amount > self.MAX_EEPROM:
+            self.send(bytes([INPUT_PREFIX, 0x21, 0, 0, 0x08, 0, 0] + [0] * 16))
+            return
+        for offset in range(0, amount, 16):
+            size = min(16, amount - offset)
+            start = address + offset
+            if eeprom:
+                chunk = list(self.eeprom[start:start + size])
+            else:
+                chunk = [self.registers.get(start + idx, 0) for idx in range(size)]
+            self.send(bytes([INPUT_PREFIX, 0x21, 0, 0, (size - 1) << 4,
+                             (start >> 8) & 0xff, start & 0xff] + chunk + [0] * (16 - size)))
+
+    def close(self):
+        self.connected = False
+        self.control.close()
+        self.data.close()
+
+
+class Emulator(threading.Thread):
+    """
+    The Emulator is a socket factory for wiimote.connect and emulates
+    any number of Wiimotes in one thread. Each of them sends its reports
+    at the given rate and follows the trace set for its address.
+    """
+
+    PREFIX = "emu"
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, rate=100, trace=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.rate = rate
+        self.default_trace = trace
+        self.traces = {}
+        self.controllers = {}
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+
+    # Returns the emulator shared by the Devices.
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = Emulator()
+            return cls._instance
+
+    # Sets the trace of the Wiimote with the address, before it is connected.
+    def set_trace(self, address, trace):
+        self.traces[address] = trace
+
+    def __call__(self, btaddr):
+        control, control_peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        data, data_peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        trace = self.traces.get(btaddr, self.default_trace)
+        if trace is None:
+            trace = Trace()
+        controller = EmulatedWiimote(btaddr, control_peer, data_peer, trace, self.rate)
+        with self._lock:
+            self._pending.append(controller)
+            if not self.is_alive():
+                self.start()
+        try:
+            self._wakeup_send.send(b"\x00")
+        except BlockingIOError:
+            pass
+        return control, data
+
+    def _add_pending(self, schedule):
+        try:
+            while self._wakeup_recv.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        for controller in pending:
+            self.controllers[controller.address] = controller
+            # Both channels are read, as the model decides where commands are sent.
+            self._selector.register(controller.control, selectors.EVENT_READ, controller)
+            self._selector.register(controller.data, selectors.EVENT_READ, controller)
+            heapq.heappush(schedule, (controller.next_report, id(controller), controller))
+
+    def _remove(self, controller):
+        if self.controllers.get(controller.address) is controller:
+            del self.controllers[controller.address]
+        for sock in (controller.control, controller.data):
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        controller.close()
+
+    def run(self):
+        schedule = []
+        while True:
+            timeout = None
+            if len(schedule) > 0:
+                timeout = max(0, schedule[0][0] - time.monotonic())
+            for key, _ in self._selector.select(timeout):
+                controller = key.data
+                if controller is None:
+                    self._add_pending(schedule)
+                    continue
+                try:
+                    msg = key.fileobj.recv(64)
+                except OSError:
+                    msg = b""
+                if len(msg) == 0:  # wiimote.py disconnected
+                    self._remove(controller)
+                else:
+                    controller.handle_command(msg)
+            now = time.monotonic()
+            while len(schedule) > 0 and schedule[0][0] <= now:
+                _, key, controller = heapq.heappop(schedule)
+                if not controller.connected:
+                    self._remove(controller)
+                    continue
+                next_report = controller.send_report(now)
+                if not controller.connected:
+                    self._remove(controller)
+                    continue
+                heapq.heappush(schedule, (next_report, key, controller))
+
+
+# Connects the emulated Wiimotes and counts their reports.
+def load_test(controllers, rate, duration, trace_file=None, devices=False):
+    emulator = Emulator(rate=rate)
+    if trace_file is not None:
+        if trace_file.endswith(".csv"):
+            emulator.default_trace = CsvTrace(trace_file, rate)
+        else:
+            emulator.default_trace = SessionTrace(trace_file)
+    counts = {}
+    wms = []
+    connect_times = []
+    for idx in range(controllers):
+        address = "%s%d" % (Emulator.PREFIX, idx)
+        counts[address] = 0
+        start = time.perf_counter()
+        if devices:
+            from bt_input import Device
+            wm = Device(address, wm=wiimote.connect(address, socket_factory=emulator)).wm
+        else:
+            wm = wiimote.connect(address, socket_factory=emulator)
+        connect_times.append(time.perf_counter() - start)
+
+        def count(report, address=address):
+            counts[address] += 1
+        wm.register_report_callback(count)
+        wms.append(wm)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    before = sum(counts.values())
+    time.sleep(duration)
+    received = sum(counts.values()) - before
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    for wm in wms:
+        wm.disconnect()
+    expected = controllers * rate * elapsed
+    return {"controllers": controllers,
+            "rate": rate,
+            "duration_s": elapsed,
+            "connect_mean_ms": sum(connect_times) / len(connect_times) * 1000,
+            "connect_max_ms": max(connect_times) * 1000,
+            "received": received,
+            "reports_per_s": received / elapsed,
+            "delivered": received / expected if expected > 0 else 0,
+            "cpu_percent": cpu / elapsed * 100}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wiimote emulator load test")
+    parser.add_argument("--controllers", type=int, default=10)
+    parser.add_argument("--rate", type=int, default=100, help="reports per second")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--trace", default=None,
+                        help="csv file of accelerometer samples or recorded session")
+    parser.add_argument("--devices", action="store_true",
+                        help="create a Device with activity recognition per controller")
+    args = parser.parse_args()
+    result = load_test(args.controllers, args.rate, args.duration, args.trace, args.devices)
+    print("%d controllers at %d Hz: %.0f reports/s received (%.1f%% of the expected ones), "
+          "connect %.1f ms (max %.1f ms), cpu %.0f%%" %
+          (result["controllers"], result["rate"], result["reports_per_s"],
+           result["delivered"] * 100, result["connect_mean_ms"],
+           result["connect_max_ms"], result["cpu_percent"]))
+
+
+if __name__ == "__main__":
+    main()
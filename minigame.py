@@ -10,9 +10,214 @@ Author: Thomas Oswald
 """
 
 from PyQt5 import QtWidgets, QtCore, QtGui
-from recognizer import Recognizer
-from random import randint
+from concurrent.futures import ThreadPoolExecutor
+from recognizer import Recognizer, StreamingRecognizer
+from templates import TemplateStore
 from bt_input import Device
+import threading
+
+
+class RecognitionService(QtCore.QObject):
+
+    """
+    The RecognitionService runs the $1 recognition in a thread pool,
+    so that the matching never blocks the Qt event loop.
+    Each player can have one request at a time. The results are delivered
+    back to the Qt thread through the result_ready signal.
+    A unistroke can also be streamed point by point while it is drawn.
+    The points of a player are then passed to its StreamingRecognizer
+    in batches, one batch at a time, and the provisional results are
+    delivered through the provisional_ready signal.
+    """
+
+    # template name, score, player name
+    result_ready = QtCore.pyqtSignal(str, float, str)
+    provisional_ready = QtCore.pyqtSignal(str, float, str)
+
+    # internal signals from the worker threads to the Qt thread
+    finished = QtCore.pyqtSignal(str, object)
+    stream_updated = QtCore.pyqtSignal(str, object)
+
+    # Time in ms after which a request is cancelled.
+    TIMEOUT = 2000
+
+    # The score of a cancelled or unrecognizable request,
+    # it can never win against a result.
+    TIMEOUT_SCORE = float("-inf")
+
+    def __init__(self, workers=2, timeout=TIMEOUT,
+                 engine=Recognizer.ENGINE_NUMPY, parent=None):
+        super(RecognitionService, self).__init__(parent)
+        self.timeout = timeout
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+        self.requests = {}
+        self.streams = {}
+        self.finished.connect(self.on_finished)
+        self.stream_updated.connect(self.on_stream_updated)
+
+    # Submits the points of a player. A running request of the same player
+    # will be replaced.
+    def recognize(self, points, p_name, t_name):
+        self.cancel(p_name)
+        # The points are copied, as the DrawWidget keeps appending to them.
+        future = self.executor.submit(self.run, list(points), p_name, t_name)
+        timer = QtCore.QTimer(self)
+        timer.setSingleShot(True)
+        timer.timeout.connect(lambda: self.on_timeout(p_name, future))
+        timer.start(self.timeout)
+        self.requests[p_name] = (future, timer)
+        future.add_done_callback(lambda f: self.finished.emit(p_name, f))
+
+    # Executed in a worker thread.
+    # Each worker thread uses its own recognizer.
+    def run(self, points, p_name, t_name):
+        rec = getattr(self.local, "rec", None)
+        if rec is None:
+            rec = Recognizer(engine=self.engine)
+            self.local.rec = rec
+        result = []
+        rec.set_callback(lambda *args: result.append(args))
+        rec.recognize(points, p_name, t_name)
+        # Unistrokes, which could not be recognized, always lose.
+        if len(result) > 0 and result[0][0] != "None":
+            return result[0]
+        return ("None", self.TIMEOUT_SCORE, p_name)
+
+    def on_finished(self, p_name, future):
+        request = self.requests.get(p_name)
+        # Results of cancelled or replaced requests are dropped.
+        if request is None or request[0] is not future:
+            return
+        del self.requests[p_name]
+        request[1].stop()
+        try:
+            t_name, score, name = future.result()
+        except Exception as e:
+            print("Recognition failed: " + str(e))
+            t_name, score, name = "None", self.TIMEOUT_SCORE, p_name
+        self.result_ready.emit(t_name, score, name)
+
+    def on_timeout(self, p_name, future):
+        request = self.requests.get(p_name)
+        if request is None or request[0] is not future:
+            return
+        self.cancel(p_name)
+        print("Recognition of " + p_name + " timed out.")
+        self.result_ready.emit("None", self.TIMEOUT_SCORE, p_name)
+
+    # Cancels the request of a player.
+    def cancel(self, p_name):
+        request = self.requests.pop(p_name, None)
+        if request is not None:
+            future, timer = request
+            timer.stop()
+            future.cancel()
+
+    # Starts the streaming recognition of a new unistroke of a player.
+    def start_stream(self, p_name, t_name):
+        self.cancel(p_name)
+        stream = self.streams.get(p_name)
+        if stream is None:
+            stream = {"recognizer": StreamingRecognizer(Recognizer(engine=self.engine)),
+                      "stroke": 0, "job": None, "timer": None}
+            self.streams[p_name] = stream
+        if stream["timer"] is not None:
+            stream["timer"].stop()
+        # Jobs of the previous unistroke are ignored, when they finish.
+        stream.update(stroke=stream["stroke"] + 1, t_name=t_name, reset=True,
+                      points=[], finish=False, timer=None)
+        self.dispatch(p_name)
+
+    # Adds a point to the unistroke of a player.
+    def add_point(self, p_name, x, y):
+        stream = self.streams.get(p_name)
+        if stream is not None:
+            stream["points"].append((x, y))
+            self.dispatch(p_name)
+
+    # Finishes the unistroke of a player, the result is passed to result_ready.
+    def finish_stream(self, p_name):
+        stream = self.streams.get(p_name)
+        if stream is None:
+            self.result_ready.emit("None", self.TIMEOUT_SCORE, p_name)
+            return
+        stream["finish"] = True
+        stroke = stream["stroke"]
+        timer = QtCore.QTimer(self)
+        timer.setSingleShot(True)
+        timer.timeout.connect(lambda: self.on_stream_timeout(p_name, stroke))
+        timer.start(self.timeout)
+        stream["timer"] = timer
+        self.dispatch(p_name)
+
+    # Submits the pending points of a player, unless a job of the player is running.
+    def dispatch(self, p_name):
+        stream = self.streams[p_name]
+        if stream["job"] is not None:
+            return
+        if not (stream["reset"] or stream["points"] or stream["finish"]):
+            return
+        t_name = stream["t_name"] if stream["reset"] else None
+        future = self.executor.submit(self.run_stream, stream["recognizer"], t_name,
+                                      stream["points"], stream["finish"])
+        stream["job"] = (future, stream["stroke"], stream["finish"])
+        stream.update(reset=False, points=[], finish=False)
+        future.add_done_callback(lambda f: self.stream_updated.emit(p_name, f))
+
+    # Executed in a worker thread.
+    # Returns the result of the StreamingRecognizer or None.
+    def run_stream(self, recognizer, t_name, points, finish):
+        if t_name is not None:
+            recognizer.reset(t_name)
+        recognizer.add_points(points)
+        if finish:
+            return recognizer.finish()
+        return recognizer.provisional()
+
+    def on_stream_updated(self, p_name, future):
+        stream = self.streams.get(p_name)
+        if stream is None or stream["job"] is None or stream["job"][0] is not future:
+            return
+        _, stroke, finish = stream["job"]
+        stream["job"] = None
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Recognition failed: " + str(e))
+            result = ("None", self.TIMEOUT_SCORE) if finish else None
+        if stroke == stream["stroke"]:
+            if finish:
+                if stream["timer"] is not None:
+                    stream["timer"].stop()
+                    stream["timer"] = None
+                    # Unistrokes, which could not be recognized, always lose.
+                    if result is None:
+                        result = ("None", self.TIMEOUT_SCORE)
+                    self.result_ready.emit(result[0], result[1], p_name)
+            elif result is not None:
+                self.provisional_ready.emit(result[0], result[1], p_name)
+        self.dispatch(p_name)
+
+    def on_stream_timeout(self, p_name, stroke):
+        stream = self.streams.get(p_name)
+        if stream is None or stream["stroke"] != stroke or stream["timer"] is None:
+            return
+        stream["timer"] = None
+        stream.update(stroke=stroke + 1, reset=False, points=[], finish=False)
+        print("Recognition of " + p_name + " timed out.")
+        self.result_ready.emit("None", self.TIMEOUT_SCORE, p_name)
+
+    # Cancels all requests and stops the worker threads.
+    def shutdown(self):
+        for p_name in list(self.requests.keys()):
+            self.cancel(p_name)
+        for stream in self.streams.values():
+            if stream["timer"] is not None:
+                stream["timer"].stop()
+        self.streams = {}
+        self.executor.shutdown(wait=False)
 
 
 class DrawWidget(QtWidgets.QFrame):
@@ -24,6 +229,12 @@ class DrawWidget(QtWidgets.QFrame):
     # pyqtsignal for the recognition at the end of each drawing interaction
     finished_unistroke = QtCore.pyqtSignal(object, str, str)
 
+    # pyqtsignals for the streaming recognition while drawing
+    # player name, template name
+    started_unistroke = QtCore.pyqtSignal(str, str)
+    # player name, x, y
+    moved = QtCore.pyqtSignal(str, float, float)
+
     def __init__(self, name, width, height, parent=None):
         super(DrawWidget, self).__init__(parent)
         self.width = width
@@ -39,6 +250,8 @@ class DrawWidget(QtWidgets.QFrame):
         self.name = name
         self.just_started = False
         self.t_name = ""
+        # The provisional result of the streaming recognition.
+        self.result = None
 
     def init_ui(self, name, width, height):
         self.setAutoFillBackground(True)
@@ -57,12 +270,22 @@ class DrawWidget(QtWidgets.QFrame):
             qp.drawEllipse(self.cursor_pos, self.cursor_radius,
                            self.cursor_radius)
 
+    def set_result(self, t_name, score):
+        self.result = (t_name, score)
+        self.update()
+
+    # Shows the provisional result as live feedback.
+    def draw_result(self, qp):
+        if self.result is not None:
+            qp.drawText(10, 20, "%s: %d" % self.result)
+
     # Overwritten method responsible for painting
     def paintEvent(self, event):
         qp = QtGui.QPainter()
         qp.begin(self)
         qp.drawPath(self.path)
         self.draw_cursor(qp)
+        self.draw_result(qp)
         qp.end()
 
     def on_template_selected(self, t_name):
@@ -74,7 +297,10 @@ class DrawWidget(QtWidgets.QFrame):
         if btn == Device.BTN_A:
             self.click_flag = not self.click_flag
             self.just_started = True
-            if not self.click_flag:
+            if self.click_flag:
+                self.result = None
+                self.started_unistroke.emit(self.name, self.t_name)
+            else:
                 print("emitted")
                 self.finished_unistroke.emit(
                     self.positions, self.name, self.t_name)
@@ -84,6 +310,7 @@ class DrawWidget(QtWidgets.QFrame):
         if self.click_flag:
             pos = QtCore.QPoint(x, y)  # self.mapToGlobal(QtCore.QPoint(x, y))
             self.set_cursor(pos)
+            self.moved.emit(self.name, x, y)
             if self.just_started:
                 self.just_started = False
                 self.path.moveTo(pos)
@@ -137,6 +364,7 @@ class TemplateWidget(QtWidgets.QFrame):
         self.height = height
         self.init_ui(width, height)
         self.path = QtGui.QPainterPath()
+        self.store = TemplateStore.get_store()
 
     def init_ui(self, width, height):
         self.setStyleSheet(
@@ -146,9 +374,10 @@ class TemplateWidget(QtWidgets.QFrame):
 
     # This function draws a random template in the widget.
     def draw(self):
-        template = self.get_random_template().split(":")
-        t_name = template[0]
-        points = eval(template[1])
+        template = self.get_random_template()
+        if template is None:
+            return
+        t_name, points = template
         self.template_selected.emit(t_name)
 
         center = (self.width / 2, self.height / 2)
@@ -166,13 +395,9 @@ class TemplateWidget(QtWidgets.QFrame):
         qp.end()
 
     # This method selects a template randomly.
+    # Returns a tuple of the name and the points or None.
     def get_random_template(self):
-        lines = []
-        with open("strokes.map", "r") as strokes:
-            lines = strokes.readlines()
-        if len(lines) > 0:
-            return lines[randint(0, len(lines) - 1)]
-        return None
+        return self.store.random_template()
 
 
 class MiniGameWidget(QtWidgets.QWidget):
@@ -187,24 +412,30 @@ class MiniGameWidget(QtWidgets.QWidget):
 
     on_end = QtCore.pyqtSignal(str)
 
+    # If True, the unistrokes are recognized by the RecognitionService while
+    # they are drawn. Otherwise each unistroke is recognized after it is finished.
+    STREAMING = True
+
     def __init__(self, size, devices, parent=None):
         super(MiniGameWidget, self).__init__(parent)
         self.width, self.height = size
         self.scores = []
         self.player, self.conductor, self.template = self.init_ui()
-        rec_1 = Recognizer()
-        rec_2 = Recognizer()
-        rec_1.set_callback(self.on_result)
-        rec_2.set_callback(self.on_result)
+        self.service = RecognitionService(parent=self)
+        self.service.result_ready.connect(self.on_result)
 
         self.template.template_selected.connect(
             self.player.on_template_selected)
         self.template.template_selected.connect(
             self.conductor.on_template_selected)
-        self.player.finished_unistroke.connect(
-            lambda points, name, t_name: self.on_rec(rec_1, points, name, t_name))
-        self.conductor.finished_unistroke.connect(
-            lambda points, name, t_name: self.on_rec(rec_2, points, name, t_name))
+        for widget in (self.player, self.conductor):
+            if self.STREAMING:
+                widget.started_unistroke.connect(self.service.start_stream)
+                widget.moved.connect(self.service.add_point)
+                widget.finished_unistroke.connect(self.on_rec_streamed)
+            else:
+                widget.finished_unistroke.connect(self.on_rec)
+        self.service.provisional_ready.connect(self.on_provisional)
 
         self.devices = None
         if devices is not None and len(devices) > 0:
@@ -222,6 +453,7 @@ class MiniGameWidget(QtWidgets.QWidget):
         if self.devices is not None:
             for device in self.devices:
                 device.unregister_callbacks()
+        self.service.shutdown()
         self.template.setParent(None)
         self.player.setParent(None)
         self.conductor.setParent(None)
@@ -246,9 +478,21 @@ class MiniGameWidget(QtWidgets.QWidget):
 
         return (player, conductor, template)
 
-    def on_rec(self, rec, points, name, t_name):
+    # The recognition runs in the RecognitionService,
+    # its result will be passed to on_result.
+    def on_rec(self, points, name, t_name):
         print("begin rec")
-        rec.recognize(points, name, t_name)
+        self.service.recognize(points, name, t_name)
+
+    # The points were already streamed to the RecognitionService,
+    # which only needs to finish the recognition.
+    def on_rec_streamed(self, points, name, t_name):
+        self.service.finish_stream(name)
+
+    def on_provisional(self, template, score, name):
+        for widget in (self.player, self.conductor):
+            if widget.name == name:
+                widget.set_result(template, score)
 
     # This method gets the result of the recognition processes.
     # After receiving two results, it will decide who won.
@@ -256,10 +500,14 @@ class MiniGameWidget(QtWidgets.QWidget):
         print("received result")
         self.scores.append({"name": name, "score": score})
         if len(self.scores) > 1:
-            if abs(self.scores[0]["score"]) < abs(self.scores[1]["score"]):
-                self.on_end.emit(self.scores[0]["name"])
-            else:
-                self.on_end.emit(self.scores[1]["name"])
+            self.on_end.emit(self.winner(self.scores))
+
+    # Returns the name of the player, whose score is closer to 0.
+    @staticmethod
+    def winner(scores):
+        if abs(scores[0]["score"]) < abs(scores[1]["score"]):
+            return scores[0]["name"]
+        return scores[1]["name"]
 
     def connect_devices(self, devices, player, conductor):
         if len(devices) > 0:
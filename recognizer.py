@@ -9,7 +9,8 @@ Authors: Thomas Oswald, Paul Winderl
 """
 
 import math
-import os
+import numpy as np
+from templates import TemplateStore
 
 
 class Recognizer():
@@ -26,10 +27,64 @@ class Recognizer():
     see also https://depts.washington.edu/aimgroup/proj/dollar/
     """
 
-    def __init__(self, stepsize=64):
+    # Matching engines
+    # ENGINE_PYTHON: compares the sample with one template after another.
+    # ENGINE_NUMPY: compares the sample with all templates at once.
+    ENGINE_PYTHON = "python"
+    ENGINE_NUMPY = "numpy"
+
+    # Scoring modes
+    # MODE_GOLDEN_SECTION: searches the best angle iteratively.
+    # MODE_PROTRACTOR: calculates the best angle in closed form
+    # like the Protractor recognizer (Li, Y. (2010). Protractor:
+    # A fast and accurate gesture recognizer. CHI '10, pp. 2169-2172).
+    MODE_GOLDEN_SECTION = "golden_section"
+    MODE_PROTRACTOR = "protractor"
+
+    # Relative tolerance of the lower bound against rounding errors.
+    BOUND_TOLERANCE = 1e-9
+
+    # The NumPy engine compares fewer templates faster in a single pass.
+    PRUNE_NP_MIN_TEMPLATES = 32
+
+    # Amount of strokes that recognize_batch compares at once.
+    BATCH_SIZE = 256
+
+    def __init__(self, stepsize=64, store=None, engine=ENGINE_PYTHON,
+                 mode=MODE_GOLDEN_SECTION, prune=True):
         self.stepsize = stepsize
         self.recognize_flag = True
         self.callback = None
+        # The templates are shared and only parsed once.
+        if store is None:
+            store = TemplateStore.get_store()
+        self.store = store
+        self.set_engine(engine)
+        self.set_mode(mode)
+        # Buffers of the resampling.
+        self.fractions = np.linspace(0, 1, stepsize)
+        self.targets = np.empty(stepsize)
+        self.resampled = np.empty((stepsize, 2))
+        # Skips templates that cannot beat the best distance.
+        self.prune = prune
+        self.reset_stats()
+
+    def set_engine(self, engine):
+        if engine not in (self.ENGINE_PYTHON, self.ENGINE_NUMPY):
+            raise ValueError("Unknown recognizer engine: " + str(engine))
+        self.engine = engine
+
+    def set_mode(self, mode):
+        if mode not in (self.MODE_GOLDEN_SECTION, self.MODE_PROTRACTOR):
+            raise ValueError("Unknown recognizer mode: " + str(mode))
+        self.mode = mode
+
+    # Counters of the compared templates:
+    # compared: all templates a sample was compared with
+    # pruned: skipped because of their lower bound
+    # abandoned: stopped while calculating the path distance
+    def reset_stats(self):
+        self.stats = {"compared": 0, "pruned": 0, "abandoned": 0}
 
     def set_flag(self, needs_recognizing):
         self.recognize_flag = needs_recognizing
@@ -40,60 +95,113 @@ class Recognizer():
     def recognize(self, points, p_name, t_name):
         if len(points) > 1:
             points = self.resample(points)
-            points = self.rotate_to_zero(points)
-            points = self.scale_to_square(points, 100)
-            points = self.translate_to_origin(points)
-            # read in templates
-            templates = []
-            if not os.access("strokes.map", os.F_OK):
-                with open("strokes.map", "w"):
-                    pass
-            with open("strokes.map", "r") as f:
-                for line in f.readlines():
-                    parts = line.split(":")
-                    name = parts[0]
-                    if t_name == name:
-                        templates.append(
-                            {"name": name, "points": eval(parts[1])})
-            if len(templates) > 0:
-                result = self.compare(points, templates, 100)
+            if self.engine == self.ENGINE_NUMPY:
+                points = self.normalize_np(points, 100)
+            else:
+                points = self.rotate_to_zero(points.tolist())
+                points = self.scale_to_square(points, 100)
+                points = self.translate_to_origin(points)
+            result = self.match(points, t_name, 100)
+            if result is not None:
                 if result[0] is not None and self.callback is not None:
                     self.callback(result[0]["name"], result[1], p_name)
                     return
             self.callback("None", 0, p_name)
 
+    # Recognizes many strokes in one call.
+    # All strokes are normalized as one stacked array and scored against
+    # all templates of template_names at once, with the NumPy engine
+    # and the selected mode.
+    # Returns one dict per stroke with the name and the index of the best
+    # template (within the templates of template_names), its score and distance.
+    # Raises a ValueError, when a template does not have stepsize points.
+    def recognize_batch(self, strokes, template_names, size=100):
+        if isinstance(template_names, str):
+            template_names = [template_names]
+        names = []
+        stacks = []
+        vectors = []
+        for t_name in template_names:
+            for idx, points in enumerate(self.store.get(t_name)):
+                if len(points) != self.stepsize:
+                    raise ValueError("Template %d of %s has %d points, but the strokes "
+                                     "are resampled to %d points" %
+                                     (idx, t_name, len(points), self.stepsize))
+            stack = self.store.get_stack(t_name)
+            if stack is None:
+                continue
+            names += [t_name] * len(stack)
+            stacks.append(stack)
+            vectors.append(self.store.get_vectors(t_name))
+        results = [{"name": "None", "template": None,
+                    "score": 0, "distance": math.inf} for _ in strokes]
+        valid = [idx for idx, points in enumerate(strokes) if len(points) > 1]
+        if len(stacks) == 0 or len(valid) == 0:
+            return results
+        templates = np.concatenate(stacks)
+        vectors = np.concatenate(vectors)
+        for start in range(0, len(valid), self.BATCH_SIZE):
+            chunk = valid[start:start + self.BATCH_SIZE]
+            points = np.empty((len(chunk), self.stepsize, 2))
+            for row, idx in enumerate(chunk):
+                points[row] = self.resample(strokes[idx])
+            points = self.normalize_np(points, size)
+            distances = self.batch_distances_np(points, templates, vectors)
+            best = np.argmin(distances, axis=-1)
+            for row, idx in enumerate(chunk):
+                d = float(distances[row, best[row]])
+                results[idx] = {
+                    "name": names[best[row]],
+                    "template": int(best[row]),
+                    "score": 1 - d / 0.5 * math.sqrt(size * size + size * size),
+                    "distance": d}
+        return results
+
+    # Calculates the (S, T) distances of stacked samples to the templates.
+    def batch_distances_np(self, points, templates, vectors):
+        theta = math.radians(45)
+        theta_delta = math.radians(2)
+        if self.mode == self.MODE_PROTRACTOR:
+            radian = self.optimal_angle_np(points, vectors, theta)
+            return self.distance_at_angle_np(points[:, None], templates, radian)
+        return self.distance_at_best_angle_np(
+            points[:, None], templates, -theta, theta, theta_delta)
+
+    # Compares the normalized points with all templates of a name
+    # using the selected engine.
+    # Returns None, when there is no template with this name.
+    def match(self, points, t_name, size):
+        stack = self.store.get_stack(t_name)
+        if self.engine == self.ENGINE_NUMPY and stack is not None:
+            return self.compare_np(points, stack,
+                                   self.store.get_vectors(t_name),
+                                   self.store.get_radii(t_name), t_name, size)
+        if isinstance(points, np.ndarray):
+            points = points.tolist()
+        templates = self.store.get_templates(t_name)
+        if len(templates) > 0:
+            return self.compare(points, templates, size)
+        return None
+
     # Takes the points of the unistroke as input.
-    # Calculates the distance distance between two points.
-    # Returns the calculated points.
+    # Resamples them to stepsize points, which are spaced equally along the path.
+    # The input is not changed. The result is written into a buffer,
+    # which is reused by the next call.
     def resample(self, points):
-        # length of each increment
-        inc_length = self.get_path_length(points) / (self.stepsize - 1)
-        new_points = []
-        new_points.append(points[0])
-        whole_distance = 0
-        try:
-            for idx, point in enumerate(points):
-                if idx == 0:
-                    continue
-                last_pos = points[idx - 1]
-                d = self.distance(last_pos, point)
-                if whole_distance + d >= inc_length:
-                    qx = last_pos[0] + ((inc_length - whole_distance) / d) * \
-                        (point[0] - last_pos[0])
-                    qy = last_pos[1] + ((inc_length - whole_distance) / d) * \
-                        (point[1] - last_pos[1])
-                    new_points.append((qx, qy))
-                    points.insert(idx, (qx, qy))
-                    whole_distance = 0
-                else:
-                    whole_distance += d
-            if len(new_points) == 63:
-                new_points.append(points[-1])
-            if len(new_points) > 64:
-                return new_points[63:]
-        except Exception as e:
-            print(e)
-        return new_points
+        points = np.asarray(points, dtype=float)
+        segments = np.sqrt(np.sum(np.square(np.diff(points, axis=0)), axis=1))
+        lengths = np.empty(len(points))
+        lengths[0] = 0
+        np.cumsum(segments, out=lengths[1:])
+        return self.interpolate(points, lengths)
+
+    # Interpolates stepsize points at equal distances along the path,
+    # given the points and their cumulative arc length.
+    def interpolate(self, points, lengths):
+        np.multiply(self.fractions, lengths[-1], out=self.targets)
+        self.resampled[:, 0] = np.interp(self.targets, lengths, points[:, 0])
+        self.resampled[:, 1] = np.interp(self.targets, lengths, points[:, 1])
+        return self.resampled
 
     # Gets two points
     # Calculates and returns the distance between them.
@@ -169,18 +277,42 @@ class Recognizer():
 
     # Compares minimum distances between sample and templates
     # Returns the best matching template
+    # The templates are compared in the order of their lower bound,
+    # the remaining ones are skipped as soon as their bound exceeds
+    # the best distance. Equal distances are decided by the template order,
+    # so the result is the same as comparing every template.
     def compare(self, sample, templates, size):
         b = None
+        b_idx = None
         s_template = None
         theta = math.radians(45)
         theta_delta = math.radians(2)
-        for t in templates:
-            d = self.distance_at_best_angle(
-                sample, t["points"], -theta, theta, theta_delta)
-            if b is None:
-                b = d
-            if d < b:
+        self.stats["compared"] += len(templates)
+        order = range(len(templates))
+        if self.prune:
+            radii, offset = self.sample_radii(sample)
+            bounds = [self.lower_bound(radii, t["radii"], offset)
+                      for t in templates]
+            order = sorted(order, key=lambda idx: bounds[idx])
+        for count, idx in enumerate(order):
+            t = templates[idx]
+            if b is not None and self.prune and \
+                    bounds[idx] - self.BOUND_TOLERANCE * (1 + b) > b:
+                self.stats["pruned"] += len(templates) - count
+                break
+            if self.mode == self.MODE_PROTRACTOR:
+                radian = self.optimal_angle(sample, t["vector"], theta)
+                limit = b if self.prune else None
+                d = self.distance_at_angle(sample, t["points"], radian, limit)
+                if d is None:
+                    self.stats["abandoned"] += 1
+                    continue
+            else:
+                d = self.distance_at_best_angle(
+                    sample, t["points"], -theta, theta, theta_delta)
+            if b is None or d < b or (d == b and idx < b_idx):
                 b = d
+                b_idx = idx
                 s_template = t
         score = 1 - b / 0.5 * math.sqrt(size * size + size * size)
         return (s_template, score)
@@ -209,13 +341,263 @@ class Recognizer():
                 f2 = self.distance_at_angle(points, template, x2)
         return min(f1, f2)
 
-    def distance_at_angle(self, points, template, theta):
+    def distance_at_angle(self, points, template, theta, limit=None):
         points = self.rotate_by(points, theta)
-        return self.path_distance(points, template)
+        return self.path_distance(points, template, limit)
+
+    # Calculates the distances of the points to their centroid.
+    # Returns them with the slack, which the centroid adds to the lower bound.
+    def sample_radii(self, points):
+        c = self.centroid(points)
+        radii = [self.distance(point, c) for point in points]
+        length = len(points)
+        return radii, (length - 1) / length * math.hypot(c[0], c[1])
+
+    # Lower bound of the path distance at any angle.
+    # A rotation around the centroid keeps the distances to it, so each
+    # point can not get closer to its template point than the difference
+    # of their distances to the centroid.
+    def lower_bound(self, radii, t_radii, offset):
+        d = 0
+        length = len(radii)
+        for idx in range(length - 1):
+            d += abs(radii[idx] - t_radii[idx])
+        return d / length - offset
+
+    # Calculates the angle which rotates the points closest to the
+    # template in closed form, limited to [-theta, theta].
+    # The template is given as centered unit vector.
+    def optimal_angle(self, points, vector, theta):
+        c = self.centroid(points)
+        a = 0
+        b = 0
+        for point, t in zip(points, vector):
+            x = point[0] - c[0]
+            y = point[1] - c[1]
+            a += t[0] * x + t[1] * y
+            b += t[0] * y - t[1] * x
+        radian = math.atan2(-b, a)
+        return min(max(radian, -theta), theta)
 
-    def path_distance(self, a, b):
+    # Returns None, when the distance will be greater than limit.
+    def path_distance(self, a, b, limit=None):
         d = 0
         length = len(a)
+        if limit is not None:
+            limit_sum = limit * length
         for idx in range(length - 1):
             d += self.distance(a[idx], b[idx])
+            if limit is not None and d > limit_sum and d / length > limit:
+                return None
+        return d / length
+
+    # The following methods are the NumPy engine.
+    # They keep the points as (N, 2) arrays and compare
+    # the sample with all (T, N, 2) templates at once.
+
+    # Rotates the resampled points to their indicative angle,
+    # scales them to a square of size and translates them to the origin.
+    def normalize_np(self, points, size):
+        points = self.rotate_to_zero_np(points)
+        points = self.scale_to_square_np(points, size)
+        return self.translate_to_origin_np(points)
+
+    # These work on a single (N, 2) array or on stacked (S, N, 2) arrays.
+    def rotate_to_zero_np(self, points):
+        points = np.asarray(points, dtype=float)
+        c = points.mean(axis=-2)
+        radian = np.arctan2(c[..., 1] - points[..., 0, 1],
+                            c[..., 0] - points[..., 0, 0])
+        return self.rotate_by_np(points, -radian)
+
+    def scale_to_square_np(self, points, size):
+        box = points.max(axis=-2) - points.min(axis=-2)
+        # A straight line has no extent in one dimension.
+        box[box == 0] = 1
+        return points * (size / box)[..., None, :]
+
+    def translate_to_origin_np(self, points):
+        return points - points.mean(axis=-2, keepdims=True)
+
+    # Compares minimum distances between sample and the stacked templates
+    # Returns the best matching template
+    # Like compare, the template with the lowest bound is compared first.
+    # All templates whose bound does not exceed its distance are compared
+    # at once afterwards.
+    def compare_np(self, sample, templates, vectors, radii, t_name, size):
+        sample = np.asarray(sample, dtype=float)
+        self.stats["compared"] += len(templates)
+        if self.prune and len(templates) >= self.PRUNE_NP_MIN_TEMPLATES:
+            bounds = self.lower_bound_np(sample, radii)
+            first = int(np.argmin(bounds))
+            distances = np.full(len(templates), np.inf)
+            distances[first] = self.distances_np(
+                sample, templates[first:first + 1], vectors[first:first + 1])[0]
+            d = distances[first]
+            keep = bounds - self.BOUND_TOLERANCE * (1 + d) <= d
+            keep[first] = False
+            if np.any(keep):
+                distances[keep] = self.distances_np(
+                    sample, templates[keep], vectors[keep])
+            self.stats["pruned"] += len(templates) - 1 - int(keep.sum())
+        else:
+            distances = self.distances_np(sample, templates, vectors)
+        # argmin returns the first of equal distances like compare does.
+        idx = int(np.argmin(distances))
+        b = float(distances[idx])
+        score = 1 - b / 0.5 * math.sqrt(size * size + size * size)
+        return ({"name": t_name, "points": templates[idx]}, score)
+
+    # Calculates the distance at the best angle for each template.
+    def distances_np(self, sample, templates, vectors):
+        theta = math.radians(45)
+        theta_delta = math.radians(2)
+        if self.mode == self.MODE_PROTRACTOR:
+            radian = self.optimal_angle_np(sample, vectors, theta)
+            return self.distance_at_angle_np(sample, templates, radian)
+        return self.distance_at_best_angle_np(
+            sample, templates, -theta, theta, theta_delta)
+
+    # Lower bound of the path distance for all templates, see lower_bound.
+    def lower_bound_np(self, points, t_radii):
+        length = points.shape[-2]
+        c = points.mean(axis=-2, keepdims=True)
+        radii = np.sqrt(np.sum(np.square(points - c), axis=-1))
+        offset = (length - 1) / length * np.sqrt(np.sum(np.square(c), axis=-1))
+        d = np.abs(radii[..., None, :length - 1] -
+                   t_radii[..., :length - 1]).sum(axis=-1)
+        return d / length - offset
+
+    # Golden section search for all templates at once.
+    # Every template needs the same number of iterations,
+    # only the chosen side of the interval differs.
+    def distance_at_best_angle_np(self, points, templates,
+                                  theta_a, theta_b, theta_c):
+        count = templates.shape[:-2]
+        theta_a = np.full(count, theta_a)
+        theta_b = np.full(count, theta_b)
+        phi = 0.5 * (-1 + math.sqrt(5))
+        x1 = phi * theta_a + (1 - phi) * theta_b
+        f1 = self.distance_at_angle_np(points, templates, x1)
+        x2 = (1 - phi) * theta_a + phi * theta_b
+        f2 = self.distance_at_angle_np(points, templates, x2)
+        while np.any(np.abs(theta_b - theta_a) > theta_c):
+            left = f1 < f2
+            theta_b = np.where(left, x2, theta_b)
+            theta_a = np.where(left, theta_a, x1)
+            new_x1 = phi * theta_a + (1 - phi) * theta_b
+            new_x2 = (1 - phi) * theta_a + phi * theta_b
+            x = np.where(left, new_x1, new_x2)
+            f = self.distance_at_angle_np(points, templates, x)
+            x1, x2 = np.where(left, x, x2), np.where(left, x1, x)
+            f1, f2 = np.where(left, f, f2), np.where(left, f1, f)
+        return np.minimum(f1, f2)
+
+    def distance_at_angle_np(self, points, templates, theta):
+        points = self.rotate_by_np(points, theta)
+        return self.path_distance_np(points, templates)
+
+    # Calculates the closed form angle for all template vectors at once.
+    def optimal_angle_np(self, points, vectors, theta):
+        centered = points - points.mean(axis=-2, keepdims=True)
+        a = np.sum(vectors * centered[..., None, :, :], axis=(-2, -1))
+        b = np.sum(vectors[..., 0] * centered[..., None, :, 1] -
+                   vectors[..., 1] * centered[..., None, :, 0], axis=-1)
+        return np.clip(np.arctan2(-b, a), -theta, theta)
+
+    # Rotates the points around their centroid by every given radian.
+    # Returns an array of shape radian.shape + (N, 2).
+    def rotate_by_np(self, points, radian):
+        c = points.mean(axis=-2, keepdims=True)
+        centered = points - c
+        cos = np.cos(radian)[..., None]
+        sin = np.sin(radian)[..., None]
+        x = centered[..., 0] * cos - centered[..., 1] * sin
+        y = centered[..., 0] * sin + centered[..., 1] * cos
+        return np.stack((x, y), axis=-1) + c
+
+    def path_distance_np(self, a, b):
+        length = a.shape[-2]
+        diff = a[..., :length - 1, :] - b[..., :length - 1, :]
+        d = np.sqrt(np.sum(diff * diff, axis=-1)).sum(axis=-1)
         return d / length
+
+
+class StreamingRecognizer():
+
+    """
+    The StreamingRecognizer is fed with the points of a unistroke while it is
+    still being drawn. It keeps the running path length of the stroke,
+    so that resampling is a single interpolation over the arc length.
+    A provisional result is updated every few points and the final result
+    only needs one more update, when the stroke is finished.
+    """
+
+    # Amount of new points after which the provisional result is updated.
+    UPDATE_INTERVAL = 4
+
+    # Initial capacity of the point buffer, it doubles when needed.
+    CAPACITY = 256
+
+    def __init__(self, recognizer=None, update_interval=UPDATE_INTERVAL):
+        if recognizer is None:
+            recognizer = Recognizer(engine=Recognizer.ENGINE_NUMPY)
+        self.rec = recognizer
+        self.update_interval = update_interval
+        self.points = np.empty((self.CAPACITY, 2))
+        self.lengths = np.empty(self.CAPACITY)
+        self.reset()
+
+    # Starts a new stroke, which will be compared with the templates of t_name.
+    def reset(self, t_name=None):
+        self.t_name = t_name
+        self.count = 0
+        self.path_length = 0.0
+        self.last_update = 0
+        self.result = None
+
+    def add_point(self, x, y):
+        self.add_points(((x, y),))
+
+    # Adds several points at once, the result is updated at most once.
+    def add_points(self, points):
+        for x, y in points:
+            if self.count == len(self.points):
+                self.points = np.concatenate((self.points, np.empty_like(self.points)))
+                self.lengths = np.concatenate((self.lengths, np.empty_like(self.lengths)))
+            if self.count > 0:
+                last = self.points[self.count - 1]
+                self.path_length += math.hypot(x - last[0], y - last[1])
+            self.points[self.count] = (x, y)
+            self.lengths[self.count] = self.path_length
+            self.count += 1
+        if self.count - self.last_update >= self.update_interval:
+            self.update()
+
+    # Resamples the stroke to the stepsize of the recognizer.
+    # The points are spaced equally along the path.
+    def resample(self):
+        count = self.count
+        return self.rec.interpolate(self.points[:count], self.lengths[:count])
+
+    # Matches the current stroke with the templates.
+    def update(self):
+        self.last_update = self.count
+        if self.count < 2 or self.path_length == 0 or self.t_name is None:
+            return self.result
+        points = self.rec.normalize_np(self.resample(), 100)
+        result = self.rec.match(points, self.t_name, 100)
+        if result is not None:
+            self.result = (result[0]["name"], result[1])
+        return self.result
+
+    # Returns a tuple of the best template name and its score
+    # or None, if there is no result yet.
+    def provisional(self):
+        return self.result
+
+    # Finishes the stroke and returns its final result like provisional.
+    def finish(self):
+        if self.count != self.last_update:
+            self.update()
+        return self.result
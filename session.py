@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+The Session module records the reports of a Wiimote into a binary log
+and replays them into a Device and its ActivityRecognizer, so that the
+activity recognition can be tested and benchmarked without a Wiimote.
+
+Log format (little-endian):
+    header: magic "ITTR", version (uint16), reserved (uint16),
+            start of the recording as unix time (float64)
+    record: time since the start in seconds (float64), kind (uint8),
+            payload size (uint8), payload
+Kinds: raw Wiimote report starting with the report type
+       or the name of the activity performed from then on (utf-8).
+
+Usage:
+    python3 session.py record <bt address> <session file> [--label violin]
+        Type the name of the current activity and press enter to change it,
+        an empty line stops the recording.
+    python3 session.py replay <session file> [--realtime] [--spectrum sliding]
+
+Author: Fabian Zürcher
+"""
+
+import argparse
+import json
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+import wiimote
+from bt_input import Device
+
+
+class SessionRecorder():
+
+    """
+    SessionRecorder writes the reports of a connected wiimote
+    and the ground truth activity into a session file.
+    """
+
+    MAGIC = b"ITTR"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHd")
+    RECORD = struct.Struct("<dBB")
+
+    KIND_REPORT = 1
+    KIND_LABEL = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file = open(filename, "wb")
+        self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, time.time()))
+        self.start = time.monotonic()
+        self.reports = 0
+        self.wm = None
+
+    # Records all reports of the wiimote from now on.
+    def attach(self, wm):
+        self.wm = wm
+        wm.register_report_callback(self.on_report)
+
+    def on_report(self, report):
+        self.write(self.KIND_REPORT, bytes(report))
+        self.reports += 1
+
+    # Sets the activity, which is performed from now on.
+    def set_label(self, name):
+        self.write(self.KIND_LABEL, name.encode("utf-8"))
+
+    def write(self, kind, payload):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(self.RECORD.pack(time.monotonic() - self.start,
+                                             kind, len(payload)))
+            self.file.write(payload)
+
+    def close(self):
+        if self.wm is not None:
+            self.wm.unregister_report_callback(self.on_report)
+        with self.lock:
+            self.file.close()
+            self.file = None
+
+    # Reads a session file.
+    # Returns the start time and a list of (time, kind, payload) tuples.
+    @classmethod
+    def read(cls, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        if len(data) < cls.HEADER.size:
+            raise ValueError("file is too short")
+        magic, version, _, start = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("wrong magic number")
+        if version != cls.VERSION:
+            raise ValueError("unsupported version %d" % version)
+        records = []
+        offset = cls.HEADER.size
+        while offset + cls.RECORD.size <= len(data):
+            t, kind, size = cls.RECORD.unpack_from(data, offset)
+            offset += cls.RECORD.size
+            records.append((t, kind, data[offset:offset + size]))
+            offset += size
+        return start, records
+
+
+class ReplayCom():
+
+    """
+    ReplayCom replaces the CommunicationHandler of a replayed wiimote.
+    Reports are handled like received ones, everything sent is dropped.
+    """
+
+    # The recorded memory replies belong to requests of the recording.
+    IGNORED_REPORTS = wiimote.Memory.SUPPORTED_REPORTS
+
+    def __init__(self, wiimote_):
+        self.wiimote = wiimote_
+        self.btaddr = wiimote_.btaddr
+        self.model = wiimote_.model
+        self.rumble = False
+        self.reporting_mode = wiimote.CommunicationHandler.MODE_ACC_IR
+        self.report_callbacks = []
+
+    _handle = wiimote.CommunicationHandler._handle
+
+    def handle(self, report):
+        if report[0] not in self.IGNORED_REPORTS:
+            self._handle(b"\xa1" + report)
+
+    def _send(self, *bytes_to_send, signed=False):
+        pass
+
+    def set_report_mode(self, mode):
+        self.reporting_mode = mode
+
+    def set_rumble(self, state):
+        self.rumble = state
+
+
+class ReplayWiiMote(wiimote.WiiMote):
+
+    """
+    ReplayWiiMote has the sensors of a WiiMote, but gets its reports
+    from a session file instead of a bluetooth connection.
+    """
+
+    def __init__(self, btaddr="replay", model=wiimote.KNOWN_DEVICES[0]):
+        self.btaddr = btaddr
+        self.model = model
+        self.connected = True
+        self._com = ReplayCom(self)
+        self._leds = wiimote.LEDs(self)
+        self.accelerometer = wiimote.Accelerometer(self)
+        self.buttons = wiimote.Buttons(self)
+        self.rumbler = wiimote.Rumbler(self)
+        self.speaker = wiimote.Speaker(self)
+        self.memory = wiimote.Memory(self)
+        self.ir = wiimote.IRCam(self)
+
+    def handle(self, report):
+        self._com.handle(report)
+
+
+class SessionPlayer():
+
+    """
+    SessionPlayer feeds a recorded session into a Device. The activity is
+    classified at the update rate of the ActivityRecognizer in recorded time
+    and compared with the recorded ground truth.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.start, self.records = SessionRecorder.read(filename)
+
+    # Replays the session either as fast as possible or in real time.
+    # spectrum selects the feature extraction of the ActivityRecognizer.
+    # Returns the statistics of the replay as dict.
+    def replay(self, realtime=False, spectrum=None):
+        wm = ReplayWiiMote()
+        device = Device("replay", wm=wm)
+        ar = device.ar
+        # The player classifies itself, so that the results are reproducible.
+        ar.stop()
+        if spectrum is not None:
+            ar.set_spectrum(spectrum)
+        interval = 1.0 / ar.UPDATE_RATE
+        min_len = ar.min_len
+
+        label = None
+        samples_since_label = 0
+        next_update = 0.0
+        classified_total = ar.samples.total
+        reports = 0
+        latencies = []
+        agreement = {}
+        replay_start = time.perf_counter()
+        for t, kind, payload in self.records:
+            if realtime:
+                delay = t - (time.perf_counter() - replay_start)
+                if delay > 0:
+                    time.sleep(delay)
+            if kind == SessionRecorder.KIND_LABEL:
+                label = payload.decode("utf-8")
+                samples_since_label = 0
+                continue
+            if kind != SessionRecorder.KIND_REPORT or len(payload) == 0:
+                continue
+            wm.handle(payload)
+            device.poll()
+            reports += 1
+            if payload[0] in wiimote.Accelerometer.SUPPORTED_REPORTS:
+                samples_since_label += 1
+            if t < next_update or ar.samples.total == classified_total:
+                continue
+            next_update = t + interval
+            classified_total = ar.samples.total
+            before = time.perf_counter()
+            current_act = ar.check_activity()
+            latencies.append(time.perf_counter() - before)
+            # Windows reaching back before the last label change are not rated.
+            if current_act is None or label is None or samples_since_label < min_len:
+                continue
+            counts = agreement.setdefault(label, {"rated": 0, "agreed": 0,
+                                                  "predicted": {}})
+            predicted = ar.model.label_name(current_act[0])
+            counts["rated"] += 1
+            counts["predicted"][predicted] = counts["predicted"].get(predicted, 0) + 1
+            if predicted == label:
+                counts["agreed"] += 1
+        elapsed = time.perf_counter() - replay_start
+
+        rated = sum(counts["rated"] for counts in agreement.values())
+        agreed = sum(counts["agreed"] for counts in agreement.values())
+        result = {"session": self.filename,
+                  "recorded_duration_s": self.records[-1][0] if self.records else 0,
+                  "replay_duration_s": elapsed,
+                  "realtime": realtime,
+                  "spectrum": ar.spectrum,
+                  "reports": reports,
+                  "throughput_per_s": reports / elapsed if elapsed > 0 else 0,
+                  "classifications": len(latencies),
+                  "agreement": agreed / rated if rated > 0 else None,
+                  "queue": device.report_stats(),
+                  "labels": agreement}
+        if len(latencies) > 0:
+            values = np.asarray(latencies) * 1000
+            result["latency"] = {"mean_ms": float(values.mean()),
+                                 "p50_ms": float(np.percentile(values, 50)),
+                                 "p99_ms": float(np.percentile(values, 99))}
+        return result
+
+
+def record(args):
+    wm = wiimote.connect(args.address)
+    recorder = SessionRecorder(args.session)
+    recorder.attach(wm)
+    if args.label is not None:
+        recorder.set_label(args.label)
+    print("Recording, type an activity name to change it, an empty line stops.")
+    try:
+        for line in sys.stdin:
+            name = line.strip()
+            if len(name) == 0:
+                break
+            recorder.set_label(name)
+    except KeyboardInterrupt:
+        pass
+    recorder.close()
+    wm.disconnect()
+    print("Recorded %d reports to %s." % (recorder.reports, args.session))
+
+
+def replay(args):
+    result = SessionPlayer(args.session).replay(args.realtime, args.spectrum)
+    print("%d reports in %.3f s (%.0f reports/s), %d classifications" %
+          (result["reports"], result["replay_duration_s"],
+           result["throughput_per_s"], result["classifications"]))
+    if "latency" in result:
+        print("Latency: mean %.3f ms  p50 %.3f ms  p99 %.3f ms" %
+              (result["latency"]["mean_ms"], result["latency"]["p50_ms"],
+               result["latency"]["p99_ms"]))
+    for label, counts in result["labels"].items():
+        print("%-10s %5.1f%% of %d agreed  %s" %
+              (label, counts["agreed"] / counts["rated"] * 100,
+               counts["rated"], counts["predicted"]))
+    if result["agreement"] is not None:
+        print("Agreement: %.1f%%" % (result["agreement"] * 100))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wiimote session recorder and replay")
+    commands = parser.add_subparsers(dest="command")
+    parser_record = commands.add_parser("record")
+    parser_record.add_argument("address")
+    parser_record.add_argument("session")
+    parser_record.add_argument("--label", default=None,
+                               help="activity at the start of the recording")
+    parser_replay = commands.add_parser("replay")
+    parser_replay.add_argument("session")
+    parser_replay.add_argument("--realtime", action="store_true")
+    parser_replay.add_argument("--spectrum", default=None,
+                               choices=["batch", "sliding"])
+    parser_replay.add_argument("--output", default=None,
+                               help="write the results as JSON")
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args)
+    elif args.command == "replay":
+        replay(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,11 @@ Author: Thomas Oswald
 """
 
 from PyQt5 import QtWidgets, QtCore, QtGui
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from activity_recognizer import ActivityModel
 from bt_input import Device
-from bluetooth import BluetoothError
-from time import sleep
+import threading
+import time
 import sys
 
 
@@ -22,28 +24,102 @@ class SetupThread(QtCore.QThread):
 
     """
     The SetupThread handles the search for the bluetooth addresses.
-    It will return a device, when one was found.
-    If this is not the case the game can't start and will output an error.
+    All addresses are connected at the same time and each device is
+    returned with the index of its address, as soon as it was found.
+    If a device can not be connected, the game can't start and will output an error.
     """
 
-    device_found = QtCore.pyqtSignal(object)
+    device_found = QtCore.pyqtSignal(int, object)
     exception_raised = QtCore.pyqtSignal()
 
+    # Maximum time in seconds for connecting a device.
+    CONNECT_TIMEOUT = 15
+
+    # Amount of further attempts after a failed connection.
+    RETRIES = 2
+
+    PHASES = ["name_lookup", "socket_connect", "ir_init", "model_load"]
+
     def __init__(self, addresses, parent=None):
         super(SetupThread, self).__init__(parent)
         self.addresses = addresses
 
     def run(self):
-        try:
-            if self.addresses is not None:
-                for address in self.addresses:
-                    self.device_found.emit(Device(address))
-        except ValueError as e:
-            print(e)
-            print(
-                "Game is not able to start, because no bluetooth device could be found.")
-            self.exception_raised.emit()
+        if self.addresses is None or len(self.addresses) == 0:
             return
+        failed = False
+        with ThreadPoolExecutor(len(self.addresses) + 1) as executor:
+            # The activity model is loaded while the devices connect.
+            executor.submit(ActivityModel.get_instance)
+            futures = {executor.submit(self.connect, address): idx
+                       for idx, address in enumerate(self.addresses)}
+            for future in as_completed(futures):
+                device = future.result()
+                if device is None:
+                    failed = True
+                else:
+                    self.device_found.emit(futures[future], device)
+        if failed:
+            print("Game is not able to start, because no bluetooth device could be found.")
+            self.exception_raised.emit()
+
+    # Connects a device with retries.
+    # Returns the device or None, if all attempts failed.
+    def connect(self, address):
+        thread = None
+        for attempt in range(1, self.RETRIES + 2):
+            # A timed out attempt may still be connecting and
+            # two connections to the same device would interfere.
+            if thread is not None and thread.is_alive():
+                thread.join(self.CONNECT_TIMEOUT)
+                if thread.is_alive():
+                    print("Connecting %s is still blocked, no further attempts." % address)
+                    return None
+            start = time.perf_counter()
+            result, thread = self.attempt(address)
+            if isinstance(result, Device):
+                self.print_timings(address, result.timings, time.perf_counter() - start)
+                return result
+            print("Connecting %s failed (attempt %d of %d): %s" %
+                  (address, attempt, self.RETRIES + 1, result))
+        return None
+
+    # Connects a device in its own thread, as the bluetooth calls can not be interrupted.
+    # Returns the device or the reason of the failure and the thread of the attempt.
+    def attempt(self, address):
+        result = {}
+        # Guards the result, so that a device is either returned or disconnected.
+        lock = threading.Lock()
+
+        def target():
+            try:
+                device = Device(address)
+            except Exception as e:
+                result["error"] = e
+                return
+            with lock:
+                # The attempt has timed out in the meantime.
+                if not result.get("abandoned"):
+                    result["device"] = device
+                    return
+            device.ar.stop()
+            device.wm.disconnect()
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(self.CONNECT_TIMEOUT)
+        with lock:
+            result["abandoned"] = True
+        if "device" in result:
+            return result["device"], thread
+        if "error" in result:
+            return result["error"], thread
+        return "timeout after %d s" % self.CONNECT_TIMEOUT, thread
+
+    def print_timings(self, address, timings, total):
+        phases = ", ".join("%s %.0f ms" % (phase.replace("_", " "), timings[phase] * 1000)
+                           for phase in self.PHASES if phase in timings)
+        print("Connected %s in %.0f ms (%s)" % (address, total * 1000, phases))
 
 
 class SetupWidget(QtWidgets.QWidget):
@@ -58,10 +134,14 @@ class SetupWidget(QtWidgets.QWidget):
 
     DEVICE_LIMIT = 2
 
+    # Time in ms the connected devices are displayed, before the setup ends.
+    END_DELAY = 2000
+
     def __init__(self, size, parent=None):
         super(SetupWidget, self).__init__(parent)
         self.width, self.height = size
         self.devices = []
+        self.slots = [None] * self.DEVICE_LIMIT
         self.init_ui()
         self.setHidden(True)
 
@@ -95,29 +175,29 @@ class SetupWidget(QtWidgets.QWidget):
 
         self.setLayout(layout)
 
-    # When a device is found, it will appended to the devices list.
-    # Depending whether a device connected beforehand,
-    # the device will be declared as player or conductor.
+    # When a device is found, it will be added to the devices.
+    # The index of its address declares the device as player or conductor,
+    # regardless of which one connected first.
     # At least a callback is fired, when the DEVICE_LIMIT is reached.
-    def on_device_found(self, device):
-        if device is not None:
-            self.devices.append(device)
-        length = len(self.devices)
+    def on_device_found(self, idx, device):
+        if device is None or idx >= self.DEVICE_LIMIT:
+            return
+        self.slots[idx] = device
+        self.devices = [slot for slot in self.slots if slot is not None]
 
-        # First device will be always the player.
-        if length == 1:
+        # First address will be always the player.
+        if idx == 0:
             device.setLed(0)
             self.player.setText("Connected player.")
             self.player.repaint()
 
-        # Second device will be always the conductor.
-        elif length == 2:
+        # Second address will be always the conductor.
+        elif idx == 1:
             device.setLed(1)
             self.conductor.setText("Connected conductor.")
             self.conductor.repaint()
         if len(self.devices) == self.DEVICE_LIMIT:
-            sleep(2)
-            self.on_setup_end.emit(self.devices)
+            QtCore.QTimer.singleShot(self.END_DELAY, lambda: self.on_setup_end.emit(self.devices))
 
     def closeEvent(self, event):
         return super().closeEvent(event)
@@ -27,6 +27,9 @@ class MainWidget(QtWidgets.QMainWindow):
     BACKGROUND = "./background.png"
     MINIGAME_TIMER = 100
 
+    # Interval in ms in which the reports of the devices are handled.
+    POLL_INTERVAL = 10
+
     # Module codes.
     SETUP = 0
     MENU = 1
@@ -48,6 +51,11 @@ class MainWidget(QtWidgets.QMainWindow):
         self.minigame_winner = None
         self.addresses = addresses
 
+        # The Wiimote reports are handled on the Qt thread.
+        self.poll_timer = QtCore.QTimer(self)
+        self.poll_timer.timeout.connect(self.poll_devices)
+        self.poll_timer.start(self.POLL_INTERVAL)
+
         self.w_setup = SetupWidget(
             self.WINDOW_SIZE, parent=self.window)
         self.w_menu = MenuWidget(
@@ -113,6 +121,13 @@ class MainWidget(QtWidgets.QMainWindow):
         self.current_widget = widget
         self.show()
 
+    # Handles the queued reports of all devices.
+    # This is the only place polling them, so all callbacks run on the Qt thread,
+    # also while the game is running (the game widget only posts pygame events).
+    def poll_devices(self):
+        for device in self.devices:
+            device.poll()
+
     def on_widget_change(self, widget_type):
         self.init_widget(widget_type)
 
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+The Templates module keeps the unistroke templates of strokes.map in memory,
+so that the recognizer and the minigame do not need to read and parse the file
+every time a template is needed.
+
+Additionally, it implements a binary template format, which can be memory-mapped:
+    header: magic "ITTS", version (uint16), reserved (uint16),
+            template count (uint32), point count of all templates (uint32),
+            SHA-256 of the text file it was created from (32 bytes, since version 2)
+    index:  per template the utf-8 name (32 bytes, zero padded),
+            the offset of its first point and its point count (uint32 each)
+    data:   the x, y coordinates of all points as float32
+All values are little-endian.
+The binary file is created from strokes.map with:
+    python3 templates.py strokes.map strokes.bin
+
+Authors: Thomas Oswald, Paul Winderl
+"""
+
+import ast
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from random import randint
+
+import numpy as np
+
+
+class TemplateStore():
+
+    """
+    The TemplateStore loads and validates the templates of a template file once
+    and keeps them as (N, 2) NumPy arrays grouped by their name.
+    The file will only be read again, when its modification time changes,
+    which is checked at most once per CHECK_INTERVAL.
+    """
+
+    STROKES_FILE = "strokes.map"
+    BINARY_FILE = "strokes.bin"
+
+    # Binary format
+    MAGIC = b"ITTS"
+    VERSION = 2
+    HEADER = struct.Struct("<4sHHII32s")
+    HEADER_V1 = struct.Struct("<4sHHII")
+    NAME_SIZE = 32
+    INDEX_DTYPE = np.dtype([("name", "S32"), ("offset", "<u4"),
+                            ("count", "<u4")])
+    POINT_DTYPE = np.dtype("<f4")
+
+    # Minimum time in seconds between two checks of the modification time.
+    CHECK_INTERVAL = 1.0
+
+    # One shared store per template file.
+    _stores = {}
+    _stores_lock = threading.Lock()
+    # The warning about an outdated binary file is only printed once.
+    _stale_warned = False
+    # path: (modification time, size, SHA-256) of the hashed text files
+    _hashes = {}
+
+    def __init__(self, path=STROKES_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = None
+        self._templates = {}
+        self._stacks = {}
+        self._vectors = {}
+        self._radii = {}
+        self._lists = {}
+        self._entries = []
+
+    # Returns the shared store of a template file.
+    # By default the binary file is used, if it exists and is up to date.
+    @classmethod
+    def get_store(cls, path=None):
+        if path is None:
+            path = cls.default_path()
+        with cls._stores_lock:
+            if path not in cls._stores:
+                cls._stores[path] = cls(path)
+            return cls._stores[path]
+
+    # The binary file is only used, when it was created from the current text file,
+    # so that edits of the text file are never ignored.
+    @classmethod
+    def default_path(cls):
+        if not os.access(cls.BINARY_FILE, os.F_OK):
+            return cls.STROKES_FILE
+        if not os.access(cls.STROKES_FILE, os.F_OK):
+            return cls.BINARY_FILE
+        try:
+            source_hash = cls.read_header(cls.BINARY_FILE)[3]
+            current = source_hash == cls.hash_file(cls.STROKES_FILE)
+        except (OSError, ValueError):
+            current = False
+        if not current:
+            if not cls._stale_warned:
+                cls._stale_warned = True
+                print("%s was not created from the current %s and is not used, "
+                      "recreate it with: python3 templates.py %s %s" %
+                      (cls.BINARY_FILE, cls.STROKES_FILE, cls.STROKES_FILE, cls.BINARY_FILE))
+            return cls.STROKES_FILE
+        return cls.BINARY_FILE
+
+    # Returns the SHA-256 of a file.
+    # It is only calculated again, when the file has changed.
+    @classmethod
+    def hash_file(cls, path):
+        stat = os.stat(path)
+        cached = cls._hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).digest()
+        cls._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    # Returns all templates of a name as a list of (N, 2) arrays.
+    def get(self, name):
+        self.reload_if_changed()
+        return self._templates.get(name, [])
+
+    # Returns all templates of a name stacked into one (T, N, 2) array
+    # or None, when the templates do not share the same number of points.
+    def get_stack(self, name):
+        self.reload_if_changed()
+        return self._stacks.get(name)
+
+    # Returns all templates of a name as centered unit vectors
+    # with the same shape as the stack or None like get_stack.
+    # These are used for the closed form angle of the protractor.
+    def get_vectors(self, name):
+        self.reload_if_changed()
+        return self._vectors.get(name)
+
+    # Returns the distances of the points of all templates of a name
+    # to the origin as (T, N) array or None like get_stack.
+    # These are used for the lower bound of the distance to a template.
+    def get_radii(self, name):
+        self.reload_if_changed()
+        return self._radii.get(name)
+
+    # Returns all templates of a name as dicts of lists for the Python engine.
+    # Each dict contains the name, the points, the unit vector and the radii.
+    # They are only created, when they are needed for the first time.
+    def get_templates(self, name):
+        self.reload_if_changed()
+        lists = self._lists.get(name)
+        if lists is None:
+            with self._lock:
+                lists = self._lists.get(name)
+                if lists is None:
+                    lists = [{"name": name,
+                              "points": points.tolist(),
+                              "vector": self.unit_vectors(points).tolist(),
+                              "radii": self.radii(points).tolist()}
+                             for points in self._templates.get(name, [])]
+                    self._lists[name] = lists
+        return lists
+
+    # Returns the names of all templates.
+    def names(self):
+        self.reload_if_changed()
+        return list(self._templates.keys())
+
+    # Returns the name and the points of a randomly selected template
+    # or None, when there are no templates.
+    def random_template(self):
+        self.reload_if_changed()
+        entries = self._entries
+        if len(entries) > 0:
+            return entries[randint(0, len(entries) - 1)]
+        return None
+
+    def __len__(self):
+        self.reload_if_changed()
+        return len(self._entries)
+
+    # Checks the modification time of the template file
+    # and loads the templates again, if it has changed.
+    # The check is done at most once per CHECK_INTERVAL,
+    # as every access of the templates calls it.
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.CHECK_INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime != self._mtime:
+                self._load(mtime)
+
+    def _load(self, mtime):
+        templates = {}
+        entries = []
+        stacks = {}
+        if mtime is not None:
+            if self.is_binary(self.path):
+                try:
+                    entries, stacks = self.map_binary(self.path)
+                except ValueError as e:
+                    print("Invalid template file %s: %s" % (self.path, e))
+            else:
+                entries = self.read_text(self.path)
+        for name, points in entries:
+            templates.setdefault(name, []).append(points)
+        vectors = {}
+        radii = {}
+        for name, group in templates.items():
+            if name not in stacks and len(set(len(points) for points in group)) == 1:
+                stack = np.stack(group)
+                stack.flags.writeable = False
+                stacks[name] = stack
+            if name in stacks:
+                vectors[name] = self.unit_vectors(stacks[name])
+                radii[name] = self.radii(stacks[name])
+        # Swapping the references keeps readers on a consistent state.
+        self._templates = templates
+        self._stacks = stacks
+        self._vectors = vectors
+        self._radii = radii
+        self._lists = {}
+        self._entries = entries
+        self._mtime = mtime
+
+    @classmethod
+    def is_binary(cls, path):
+        with open(path, "rb") as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    # Reads a text file with one template per line.
+    # Returns a list of (name, points) tuples.
+    @classmethod
+    def read_text(cls, path):
+        entries = []
+        with open(path, "r") as f:
+            for line_no, line in enumerate(f, 1):
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    entries.append(cls.parse_line(line))
+                except ValueError as e:
+                    print("Skipping template in %s, line %d: %s" %
+                          (path, line_no, e))
+        return entries
+
+    # Memory-maps a binary file.
+    # The points of the returned (name, points) tuples are read-only views
+    # on the mapped file, so no coordinates are parsed or copied.
+    @classmethod
+    def read_binary(cls, path):
+        return cls.map_binary(path)[0]
+
+    # Memory-maps a binary file like read_binary.
+    # Additionally returns the (T, N, 2) stacks of the names, whose templates
+    # are stored one after another with the same number of points,
+    # as views on the mapped file.
+    @classmethod
+    def map_binary(cls, path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < cls.HEADER_V1.size:
+                raise ValueError("file is too short")
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size, count, total, _ = cls.unpack_header(buf)
+        index_size = count * cls.INDEX_DTYPE.itemsize
+        data_offset = header_size + index_size
+        if size != data_offset + total * 2 * cls.POINT_DTYPE.itemsize:
+            raise ValueError("file size does not match the header")
+        index = np.frombuffer(buf, dtype=cls.INDEX_DTYPE, count=count,
+                              offset=header_size)
+        data = np.frombuffer(buf, dtype=cls.POINT_DTYPE, count=total * 2,
+                             offset=data_offset).reshape(total, 2)
+        ends = index["offset"].astype(np.int64) + index["count"]
+        if count > 0 and (ends.max() > total or index["count"].min() < 2):
+            raise ValueError("template index is out of range")
+        entries = []
+        # name: [index of the first template, amount of templates]
+        runs = {}
+        scattered = set()
+        last = None
+        for idx, (name, offset, amount) in enumerate(index.tolist()):
+            name = name.decode("utf-8")
+            entries.append((name, data[offset:offset + amount]))
+            if name == last:
+                runs[name][1] += 1
+            elif name in runs:
+                scattered.add(name)
+            else:
+                runs[name] = [idx, 1]
+            last = name
+        stacks = {}
+        for name, (first, length) in runs.items():
+            group = index[first:first + length]
+            offset = int(group["offset"][0])
+            amount = int(group["count"][0])
+            if name not in scattered and np.all(group["count"] == amount) and \
+                    np.all(group["offset"] == offset + amount * np.arange(length)):
+                stacks[name] = data[offset:offset + amount * length].reshape(
+                    length, amount, 2)
+        return entries, stacks
+
+    # Reads the header of a binary file.
+    # Returns its size, the template count, the point count
+    # and the SHA-256 of the text file (None before version 2).
+    @classmethod
+    def read_header(cls, path):
+        with open(path, "rb") as f:
+            return cls.unpack_header(f.read(cls.HEADER.size))
+
+    @classmethod
+    def unpack_header(cls, buf):
+        if len(buf) < cls.HEADER_V1.size:
+            raise ValueError("file is too short")
+        magic, version, _, count, total = cls.HEADER_V1.unpack_from(buf)
+        if magic != cls.MAGIC:
+            raise ValueError("wrong magic number")
+        if version == 1:
+            return cls.HEADER_V1.size, count, total, None
+        if version != cls.VERSION:
+            raise ValueError("unsupported version %d" % version)
+        if len(buf) < cls.HEADER.size:
+            raise ValueError("file is too short")
+        return cls.HEADER.size, count, total, cls.HEADER.unpack_from(buf)[5]
+
+    # Writes templates given as (name, points) tuples into a binary file.
+    # The templates are grouped by their name, so that the templates of a name
+    # can be used as one stack without copying them.
+    # The file is replaced atomically, as readers may have mapped it.
+    # source_hash is the SHA-256 of the text file the templates are from.
+    @classmethod
+    def write_binary(cls, path, entries, source_hash=None):
+        groups = {}
+        for name, points in entries:
+            groups.setdefault(name, []).append(points)
+        entries = [(name, points) for name, group in groups.items() for points in group]
+        index = np.zeros(len(entries), dtype=cls.INDEX_DTYPE)
+        offset = 0
+        for idx, (name, points) in enumerate(entries):
+            encoded = name.encode("utf-8")
+            if len(encoded) > cls.NAME_SIZE:
+                raise ValueError("template name is too long: " + name)
+            index[idx] = (encoded, offset, len(points))
+            offset += len(points)
+        if len(entries) > 0:
+            data = np.concatenate([points for _, points in entries])
+        else:
+            data = np.zeros((0, 2))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0,
+                                    len(entries), offset, source_hash or bytes(32)))
+            f.write(index.tobytes())
+            f.write(data.astype(cls.POINT_DTYPE).tobytes())
+        os.replace(tmp_path, path)
+
+    # Converts a template file of any format into the binary format.
+    # Returns the amount of converted templates.
+    @classmethod
+    def convert(cls, src, dst):
+        if cls.is_binary(src):
+            entries = cls.read_binary(src)
+            source_hash = cls.read_header(src)[3]
+        else:
+            entries = cls.read_text(src)
+            source_hash = cls.hash_file(src)
+        cls.write_binary(dst, entries, source_hash)
+        return len(entries)
+
+    # Centers each template at its centroid and scales it to unit length.
+    @staticmethod
+    def unit_vectors(stack):
+        centered = stack - stack.mean(axis=-2, keepdims=True)
+        norms = np.sqrt(np.sum(centered * centered, axis=(-2, -1)))
+        vectors = centered / np.maximum(norms, 1e-12)[..., None, None]
+        vectors.flags.writeable = False
+        return vectors
+
+    # Calculates the distance of each point to the origin.
+    @staticmethod
+    def radii(stack):
+        radii = np.sqrt(np.sum(np.square(stack, dtype=float), axis=-1))
+        radii.flags.writeable = False
+        return radii
+
+    # Parses a line of the form "name:[(x, y), ...]" into the name
+    # and a read-only (N, 2) array of the points.
+    @staticmethod
+    def parse_line(line):
+        name, sep, data = line.partition(":")
+        if not sep or len(name) == 0:
+            raise ValueError("missing template name")
+        try:
+            points = ast.literal_eval(data.strip())
+        except (ValueError, SyntaxError):
+            raise ValueError("points are not a valid list literal")
+        try:
+            points = np.array(points, dtype=float)
+        except (TypeError, ValueError):
+            raise ValueError("points are not a list of coordinates")
+        if points.ndim != 2 or points.shape[1] != 2 or len(points) < 2:
+            raise ValueError("points are not a list of (x, y) pairs")
+        if not np.all(np.isfinite(points)):
+            raise ValueError("points contain invalid coordinates")
+        points.flags.writeable = False
+        return name, points
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 templates.py <strokes.map> <strokes.bin>")
+        sys.exit(1)
+    amount = TemplateStore.convert(sys.argv[1], sys.argv[2])
+    print("Converted %d templates." % amount)
@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+QtCore = pytest.importorskip("PyQt5.QtCore")
+pytest.importorskip("bluetooth")
+
+from minigame import MiniGameWidget, RecognitionService  # noqa: E402
+from templates import TemplateStore  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+
+@pytest.fixture
+def service(app):
+    service = RecognitionService()
+    service.results = []
+    service.result_ready.connect(
+        lambda t_name, score, name: service.results.append({"name": name, "score": score}))
+    yield service
+    service.shutdown()
+
+
+def stream(service, p_name, t_name, points):
+    service.start_stream(p_name, t_name)
+    for x, y in points:
+        service.add_point(p_name, x, y)
+    service.finish_stream(p_name)
+
+
+def wait_for_results(app, service, amount):
+    end = time.monotonic() + 5
+    while len(service.results) < amount and time.monotonic() < end:
+        app.processEvents()
+        time.sleep(0.001)
+    return service.results
+
+
+@pytest.mark.parametrize("empty", [[], [(10, 10)]])
+def test_empty_stroke_loses(app, service, empty):
+    store = TemplateStore.get_store()
+    t_name = store.names()[0]
+    # A poorly drawn stroke still has a real score.
+    points = [(x * 3 + 7, -y) for x, y in store.get(t_name)[0].tolist()]
+    stream(service, "player", t_name, points)
+    stream(service, "conductor", t_name, empty)
+    results = wait_for_results(app, service, 2)
+    assert len(results) == 2
+    assert MiniGameWidget.winner(results) == "player"
+    assert MiniGameWidget.winner(results[::-1]) == "player"
+
+
+def test_finish_without_stream_loses(service):
+    service.finish_stream("player")
+    assert service.results == [{"name": "player",
+                                "score": RecognitionService.TIMEOUT_SCORE}]
@@ -0,0 +1,43 @@
+import math
+
+import pytest
+
+from recognizer import Recognizer
+from templates import TemplateStore
+
+
+def circle(count, radius=50):
+    return [(radius * math.cos(2 * math.pi * idx / count),
+             radius * math.sin(2 * math.pi * idx / count)) for idx in range(count)]
+
+
+def line(count, length=100):
+    return [(length * idx / (count - 1), 0.0) for idx in range(count)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = tmp_path / "strokes.map"
+    path.write_text("\n".join(["Kreis:" + str(circle(64)),
+                               "Kreis:" + str(circle(64, 80)),
+                               "Gemischt:" + str(circle(64)),
+                               "Gemischt:" + str(line(32)),
+                               "Kurz:" + str(line(32))]) + "\n")
+    return TemplateStore(str(path))
+
+
+@pytest.mark.parametrize("mode", [Recognizer.MODE_GOLDEN_SECTION,
+                                  Recognizer.MODE_PROTRACTOR])
+def test_recognize_batch(store, mode):
+    rec = Recognizer(store=store, engine=Recognizer.ENGINE_NUMPY, mode=mode)
+    results = rec.recognize_batch([circle(40, 30), [(1, 1)]], ["Kreis", "Unbekannt"])
+    assert results[0]["name"] == "Kreis"
+    assert results[1]["name"] == "None"
+
+
+@pytest.mark.parametrize("t_name, idx, count", [("Gemischt", 1, 32), ("Kurz", 0, 32)])
+def test_recognize_batch_template_lengths(store, t_name, idx, count):
+    rec = Recognizer(store=store, engine=Recognizer.ENGINE_NUMPY)
+    message = "Template %d of %s has %d points" % (idx, t_name, count)
+    with pytest.raises(ValueError, match=message):
+        rec.recognize_batch([circle(40)], ["Kreis", t_name])
@@ -9,7 +9,7 @@ http://math.stackexchange.com/questions/296794/finding-the-transform-matrix-from
 Author: Thomas Oswald
 """
 
-from numpy import matrix
+from numpy import matrix, ravel
 from numpy.linalg import solve, inv
 
 
@@ -44,7 +44,7 @@ class Transform():
         # to the unit matrix.
         scale_to_source = solve(source_points_123, source_point_4)
 
-        l, m, t = [float(x) for x in scale_to_source]
+        l, m, t = [float(x) for x in ravel(scale_to_source)]
 
         # Step 2
         # Calculating the unit matrix.
@@ -67,7 +67,7 @@ class Transform():
                                [1]])
 
         scale_to_dest = solve(dest_points_123, dest_point_4)
-        l, m, t = [float(x) for x in scale_to_dest]
+        l, m, t = [float(x) for x in ravel(scale_to_dest)]
 
         unit_to_dest = matrix([[l * A2[0], m * B2[0], t * C2[0]],
                                [l * A2[1], m * B2[1], t * C2[1]],
@@ -81,7 +81,7 @@ class Transform():
         source_to_dest = unit_to_dest @ source_to_unit
 
         # Translating the wiimote point to the destination projection.
-        x, y, z = [float(w) for w in (source_to_dest @ matrix([[wiimote_point[0]],
+        x, y, z = [float(w) for w in ravel(source_to_dest @ matrix([[wiimote_point[0]],
                                                                [wiimote_point[1]],
                                                                [1]]))]
         # Dehomogenization
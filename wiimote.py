@@ -34,8 +34,14 @@
 # based on the awesome documentation at http://wiibrew.org/wiki/Wiimote
 
 import bluetooth
+import selectors
+import socket
+import struct
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 # ################### nanosleep ########################### #
 # from https://github.com/graycatlabs/PyBBIO/blob/master/tests/sleep_test.py
@@ -87,19 +93,59 @@ def find():
     return wiimotes
 
 
-def connect(btaddr, model=None):
+def connect(btaddr, model=None, socket_factory=None):
     """
     Establishes a connection to the Wiimote at *btaddr* and returns a Wiimote
     object. If no *model* is specified, the model is determined automatically.
+    *socket_factory* replaces the bluetooth connection, see `bluetooth_sockets`.
+    Without a model, Wiimotes connected by a socket factory are
+    assumed to be the first known model.
     """
+    start = time.perf_counter()
     if model is None:
-        model = bluetooth.lookup_name(btaddr)
+        model = bluetooth.lookup_name(btaddr) if socket_factory is None else KNOWN_DEVICES[0]
+    lookup_time = time.perf_counter() - start
     if model in KNOWN_DEVICES:
-        return WiiMote(btaddr, model)
+        wm = WiiMote(btaddr, model, socket_factory)
+        wm.timings["name_lookup"] = lookup_time
+        return wm
     else:
         raise Exception("Wiimote model '%s' unknown!" % (model))
 
 
+def bluetooth_sockets(btaddr):
+    """
+    Default socket factory: connects the L2CAP control and data channels
+    of the Wiimote at *btaddr* and returns them as (control, data) tuple.
+    A socket factory is called with the address of the Wiimote and needs to
+    return two connected socket objects with send(), recv() and fileno().
+    """
+    controlsocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+    controlsocket.connect((btaddr, 17))
+    datasocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+    datasocket.connect((btaddr, 19))
+    return controlsocket, datasocket
+
+
+class SocketPair(object):
+    """
+    Socket factory that connects Wiimotes to local socket pairs instead of
+    bluetooth, e.g. for tests. The other ends of the sockets are kept in
+    `peers` as (control, data) tuple per address: reports written to the
+    data peer are received by the Wiimote, everything it sends can be read
+    from the peer of its send socket.
+    """
+
+    def __init__(self):
+        self.peers = {}
+
+    def __call__(self, btaddr):
+        control, control_peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        data, data_peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.peers[btaddr] = (control_peer, data_peer)
+        return control, data
+
+
 def _val_to_byte_list(number, num_bytes, big_endian=True):
     """
     Converts an integer into a big/little-endian multi-byte representation.
@@ -152,6 +198,13 @@ def _debug(msg):
         print("DEBUG: " + str(msg))
 
 
+def _table(func):
+    """
+    Precomputes func for all byte values, used for decoding the reports.
+    """
+    return tuple(func(b) for b in range(256))
+
+
 class Accelerometer(object):
     """
     Represents the accelerometer of the Wiimote.
@@ -159,6 +212,14 @@ class Accelerometer(object):
 
     SUPPORTED_REPORTS = [0x31, 0x33]
 
+    # Button bytes and most significant bits of x, y, z after the report type.
+    REPORT = struct.Struct("5B")
+
+    # The least significant bits are part of the button bytes.
+    X_LSB = _table(lambda b: (b & 0b01100000) >> 5)
+    Y_LSB = _table(lambda b: (b & 0b00100000) >> 4)
+    Z_LSB = _table(lambda b: (b & 0b01000000) >> 5)
+
     def __init__(self, wiimote):
         self._state = [0.0, 0.0, 0.0]
         self._wiimote = wiimote
@@ -205,14 +266,16 @@ class Accelerometer(object):
         """
         Extract accelerometer data from a Wiimote report.
         Usually gets called by the Wiimote CommunicationHandler object.
+        The state list is updated in place, callbacks need to copy the
+        values, if they keep them.
         """
         if report[0] in [0x3e, 0x3f]:  # interleaved modes
             raise NotImplementedError("Data reporting mode 0x3e/0x3f not supported")
-        x_msb, y_msb, z_msb = report[3:6]
-        x = (x_msb << 2) + ((report[1] & 0b01100000) >> 5)
-        y = (y_msb << 2) + ((report[2] & 0b00100000) >> 4)
-        z = (z_msb << 2) + ((report[2] & 0b01000000) >> 5)
-        self._state = [x, y, z]
+        btn_high, btn_low, x_msb, y_msb, z_msb = self.REPORT.unpack_from(report, 1)
+        state = self._state
+        state[0] = (x_msb << 2) + self.X_LSB[btn_high]
+        state[1] = (y_msb << 2) + self.Y_LSB[btn_low]
+        state[2] = (z_msb << 2) + self.Z_LSB[btn_low]
         self._notify_callbacks()
 
 
@@ -233,12 +296,25 @@ class Buttons(object):
                'Two': 0x0001,
                'Up': 0x0800, }
 
+    # Bits of the button word, which belong to buttons.
+    BUTTON_MASK = sum(BUTTONS.values())
+
+    # Button word after the report type.
+    REPORT = struct.Struct(">H")
+
+    # The (button, mask) pairs of each value of the high and the low byte.
+    HIGH_TABLE = _table(lambda b, buttons=sorted(BUTTONS.items()):
+                        tuple((btn, mask) for btn, mask in buttons if (mask >> 8) & b))
+    LOW_TABLE = _table(lambda b, buttons=sorted(BUTTONS.items()):
+                       tuple((btn, mask) for btn, mask in buttons if mask & 0xff & b))
+
     def __init__(self, wiimote):
         self._wiimote = wiimote
         self._com = wiimote._com
         self._state = {}
         for button in list(Buttons.BUTTONS.keys()):
             self._state[button] = False
+        self._word = 0
         self._callbacks = []
 
     def __len__(self):
@@ -281,21 +357,19 @@ class Buttons(object):
         """
         Extract button data from a Wiimote report.
         Usually gets called by the Wiimote CommunicationHandler object.
+        The callbacks are only called, when a button has changed.
         """
-        btn_bytes = (report[1] << 8) + report[2]
-        new_state = {}
-        for btn, mask in list(Buttons.BUTTONS.items()):
-            new_state[btn] = bool(mask & btn_bytes)
-        diff = self._update_state(new_state)
-        self._notify_callbacks(diff)
-
-    def _update_state(self, new_state):
+        btn_word = self.REPORT.unpack_from(report, 1)[0] & self.BUTTON_MASK
+        changed = btn_word ^ self._word
+        if changed == 0:
+            return
+        self._word = btn_word
         diff = []
-        for btn, state in list(new_state.items()):
-            if self._state[btn] != state:
-                diff.append((btn, state))
-                self._state[btn] = state
-        return diff
+        for btn, mask in self.HIGH_TABLE[changed >> 8] + self.LOW_TABLE[changed & 0xff]:
+            state = bool(btn_word & mask)
+            self._state[btn] = state
+            diff.append((btn, state))
+        self._notify_callbacks(diff)
 
 
 class LEDs(object):
@@ -414,6 +488,27 @@ class Speaker(object):
         self._playing = False
 
 
+class IRObject(object):
+    """
+    A point seen by the infrared camera. The values can also be accessed
+    like the keys of a dict, e.g. obj['x'].
+    """
+
+    __slots__ = ('id', 'x', 'y', 'size')
+
+    def __init__(self, id):
+        self.id = id
+        self.x = 0
+        self.y = 0
+        self.size = 0
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return repr({'id': self.id, 'x': self.x, 'y': self.y, 'size': self.size})
+
+
 class IRCam(object):
     """
     Represents the infrared camera of the Wiimote.
@@ -435,14 +530,20 @@ class IRCam(object):
 
     SUPPORTED_REPORTS = [0x33, 0x36, 0x37, 0x3e, 0x3f]
 
+    # Extended mode: x, y and the high bits of x, y and the size per object.
+    REPORT_EXTENDED = struct.Struct("12B")
+    X_HIGH = _table(lambda b: (b & 0b00110000) << 4)
+    Y_HIGH = _table(lambda b: (b & 0b11000000) << 2)
+    SIZE = _table(lambda b: b & 0b00001111)
+
     def __init__(self, wiimote):
         self.wiimote = wiimote
         self._com = wiimote._com
         self._state = []
+        self._objects = [IRObject(ir_obj) for ir_obj in range(4)]
         self._callbacks = []
         self._mode = self.MODE_EXTENDED
         self._sensitivity = 3
-        self.set_mode_sensitivity(self._mode, self._sensitivity)
 
     def __len__(self):
         return len(self._state)
@@ -464,6 +565,8 @@ class IRCam(object):
         Default mode: MODE_EXTENDED
         Default sensitivity: 3
         See WiiBrew documentation.
+        The register writes are pipelined, the returned Future is completed
+        when the Wiimote has acknowledged all of them.
         """
         if sensitivity > len(self.SENSITIVITY_BLOCKS) - 1 or \
            (mode not in [self.MODE_BASIC, self.MODE_EXTENDED, self.MODE_FULL]):
@@ -473,11 +576,13 @@ class IRCam(object):
         self._com.set_report_mode(0x33)  # todo: adjust for other modes!!
         self._com._send(0x13, 0x04)
         self._com._send(0x1a, 0x04)
-        self.wiimote.memory.write(0xb00030, 0x08, eeprom=False)
-        self.wiimote.memory.write(0xb00000, self.SENSITIVITY_BLOCKS[mode][0], eeprom=False)
-        self.wiimote.memory.write(0xb0001a, self.SENSITIVITY_BLOCKS[mode][1], eeprom=False)
-        self.wiimote.memory.write(0xb00033, mode, eeprom=False)
-        self.wiimote.memory.write(0xb00030, 0x08, eeprom=False)
+        memory = self.wiimote.memory
+        return _all_futures([
+            memory.write(0xb00030, 0x08, eeprom=False),
+            memory.write(0xb00000, self.SENSITIVITY_BLOCKS[mode][0], eeprom=False),
+            memory.write(0xb0001a, self.SENSITIVITY_BLOCKS[mode][1], eeprom=False),
+            memory.write(0xb00033, mode, eeprom=False),
+            memory.write(0xb00030, 0x08, eeprom=False)])
 
     def disable(self):
         pass
@@ -486,10 +591,10 @@ class IRCam(object):
         return self._state
 
     def set_sensitivity(self, sensitivity):
-        self.set_mode_sensitivity(self._mode, sensitivity)
+        return self.set_mode_sensitivity(self._mode, sensitivity)
 
     def set_mode(self, mode):
-        self.set_mode_sensitivity(mode, self._sensitivity)
+        return self.set_mode_sensitivity(mode, self._sensitivity)
 
     def register_callback(self, func):
         self._callbacks.append(func)
@@ -503,88 +608,327 @@ class IRCam(object):
             callback(self._state)
 
     def handle_report(self, report):
+        """
+        Extract the visible IR objects from a Wiimote report.
+        The state list and its IRObjects are reused for every report,
+        callbacks need to copy the values, if they keep them.
+        """
         assert(report[0] in self.SUPPORTED_REPORTS)
         # only extended mode for now!
-        ir_data = report[6:]
-        self._state = []
-        for ir_obj in range(4):
-            data = ir_data[ir_obj*3:(ir_obj+1)*3]
-            x = data[0] + ((data[2] & 0b00110000) << 4)
-            y = data[1] + ((data[2] & 0b11000000) << 2)
-            size = data[2] & 0b00001111
-            if size != 0:
-                self._state.append({'id': ir_obj, 'x': x, 'y': y, 'size': size})
+        ir_data = self.REPORT_EXTENDED.unpack_from(report, 6)
+        state = self._state
+        state.clear()
+        for ir_obj in self._objects:
+            idx = ir_obj.id * 3
+            high = ir_data[idx + 2]
+            size = self.SIZE[high]
+            # Objects, which are not seen, are sent as 0xff bytes.
+            if size != 0 and not (high == 0xff and ir_data[idx] == 0xff and ir_data[idx + 1] == 0xff):
+                ir_obj.x = ir_data[idx] + self.X_HIGH[high]
+                ir_obj.y = ir_data[idx + 1] + self.Y_HIGH[high]
+                ir_obj.size = size
+                state.append(ir_obj)
         self._notify_callbacks()
 
 
+class MemoryRequest(object):
+    """
+    A pending read or write request of the Wiimote memory.
+    """
+
+    __slots__ = ('report', 'address', 'amount', 'data', 'future', 'buffer')
+
+    def __init__(self, report, address, amount, data):
+        self.report = report
+        self.address = address
+        self.amount = amount
+        self.data = data
+        self.future = Future()
+        self.buffer = []
+
+
 class Memory(object):
+    """
+    Reads and writes the memory and registers of the Wiimote.
+    The requests are queued and each returns a concurrent.futures.Future,
+    which is completed when the Wiimote has answered. Several writes are
+    sent without waiting for the previous ones, reads are sent one after
+    another. The futures must not be waited for in a sensor callback,
+    as the answers are received on the same thread.
+    """
 
     RPT_READ = 0x17
     RPT_WRITE = 0x16
+    RPT_READ_REPLY = 0x21
+    RPT_ACK = 0x22
 
-    SUPPORTED_REPORTS = [0x21]
+    SUPPORTED_REPORTS = [RPT_READ_REPLY, RPT_ACK]
 
     MAX_ADDRESS = 0x16FF
 
+    # Maximum amount of bytes per write request.
+    CHUNK_SIZE = 16
+
+    # Maximum amount of requests sent, but not yet answered.
+    MAX_IN_FLIGHT = 4
+
     def __init__(self, wiimote):
         self.wiimote = wiimote
         self._com = wiimote._com
-        self._request_in_progress = False
-        self._bytes_requested = 0
-        self._reply_buffer = []
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._in_flight = deque()
 
     def write(self, address, data, eeprom=False):
-        address_bytes = _val_to_byte_list(address, 3, big_endian=True)
+        """
+        Writes *data* starting at *address*. Data larger than 16 bytes
+        is split into several requests. Returns a Future, which is
+        completed, when the Wiimote has acknowledged all of them.
+        """
         bytes_to_send = _flatten(data)
         amount = len(bytes_to_send)
+        if amount == 0:
+            raise ValueError("Data to write must not be empty")
         if eeprom and address + amount > Memory.MAX_ADDRESS:
             raise ValueError("EEPROM address needs to be between 0x0000 and 0x16FF")
         if address < 0:
             raise ValueError("Memory address needs to be greater than 0x0000")
-        # to do: send larger blocks in multiple 16-byte requests instead of failing
-        if amount > 16:
-            raise ValueError("A maximum of 16 bytes can be sent per function call")
-        amount_byte = _val_to_byte_list(amount, 1, big_endian=True)
-        bytes_to_send = _add_padding(bytes_to_send, 16)
         control_or_eeprom = 0x00 if eeprom else 0x04
-        self._com._send(Memory.RPT_WRITE, control_or_eeprom, address_bytes, amount_byte, bytes_to_send)
+        requests = []
+        for offset in range(0, amount, self.CHUNK_SIZE):
+            chunk = bytes_to_send[offset:offset + self.CHUNK_SIZE]
+            address_bytes = _val_to_byte_list(address + offset, 3, big_endian=True)
+            amount_byte = _val_to_byte_list(len(chunk), 1, big_endian=True)
+            report = [Memory.RPT_WRITE, control_or_eeprom, address_bytes, amount_byte,
+                      _add_padding(chunk, self.CHUNK_SIZE)]
+            requests.append(MemoryRequest(report, address + offset, len(chunk), chunk))
+        self._submit(requests)
+        if len(requests) == 1:
+            return requests[0].future
+        return _all_futures([request.future for request in requests])
 
     def read(self, address, amount, eeprom=False):
-        if self._request_in_progress:
-            raise RuntimeError("Memory read already in progress.")
+        """
+        Reads *amount* bytes starting at *address*. Returns a Future,
+        whose result is the list of the bytes read.
+        """
+        if amount <= 0:
+            raise ValueError("Amount to read needs to be greater than 0")
         if eeprom and address + amount > Memory.MAX_ADDRESS:
             raise ValueError("EEPROM address needs to be between 0x0000 and 0x16FF")
         if address < 0:
             raise ValueError("Memory address needs to be greater than 0x0000")
-        self._bytes_remaining = amount
         address_bytes = _val_to_byte_list(address, 3, big_endian=True)
         amount_bytes = _val_to_byte_list(amount, 2, big_endian=True)
         control_or_eeprom = 0x00 if eeprom else 0x04
-        self._request_in_progress = True
-        self._reply_buffer = []
-        self._com._send(Memory.RPT_READ, control_or_eeprom, address_bytes, amount_bytes)
-        # now wait until handle() has filled our reply buffer
-        while self._request_in_progress:
-            time.sleep(0.01)
-        return self._reply_buffer
+        request = MemoryRequest([Memory.RPT_READ, control_or_eeprom, address_bytes, amount_bytes],
+                                address, amount, None)
+        self._submit([request])
+        return request.future
+
+    def _submit(self, requests):
+        with self._lock:
+            self._queue.extend(requests)
+            self._send_next()
+
+    def _send_next(self):
+        # Sends queued requests as long as the limits allow it, the lock is held by the caller.
+        # The requests are sent in order, a read waits until no other read is in flight.
+        while len(self._queue) > 0 and len(self._in_flight) < self.MAX_IN_FLIGHT:
+            request = self._queue[0]
+            if request.report[0] == Memory.RPT_READ and \
+               any(sent.report[0] == Memory.RPT_READ for sent in self._in_flight):
+                break
+            self._queue.popleft()
+            self._in_flight.append(request)
+            self._com._send(*request.report)
+
+    # Returns the oldest request in flight of a report type, the lock is held by the caller.
+    def _oldest_in_flight(self, report_type):
+        for request in self._in_flight:
+            if request.report[0] == report_type:
+                return request
+        return None
+
+    def _complete(self, request, result=None, error=None):
+        # The lock is held by the caller, the futures are completed after releasing it.
+        self._in_flight.remove(request)
+        self._send_next()
+        return request, result, error
 
     def handle_report(self, report):
         if report[0] not in Memory.SUPPORTED_REPORTS:  # interleaved modes
             raise NotImplementedError("can not handle this report")
-        error = (report[3] & 0x0f)
-        if error != 0:
-            raise RuntimeError("Error condition %x received during memory read!" % error)
-        num_bytes_received = ((report[3] >> 4) & 0x0f) + 1
-        data_bytes = report[6:][:num_bytes_received]
-        self._reply_buffer += data_bytes
-        self._bytes_remaining -= num_bytes_received
-        if self._bytes_remaining < 0:
-            raise RuntimeError("Memory read received more data than requested!")
-        elif self._bytes_remaining == 0:
-            self._request_in_progress = False
+        completed = None
+        with self._lock:
+            if report[0] == Memory.RPT_ACK:
+                # Acknowledges of other output reports are not of interest.
+                if report[3] != Memory.RPT_WRITE:
+                    return
+                request = self._oldest_in_flight(Memory.RPT_WRITE)
+                if request is None:
+                    return
+                if report[4] != 0:
+                    completed = self._complete(request, error=RuntimeError(
+                        "Error condition %x received during memory write!" % report[4]))
+                else:
+                    completed = self._complete(request)
+            else:
+                request = self._oldest_in_flight(Memory.RPT_READ)
+                if request is None:
+                    return
+                error = (report[3] & 0x0f)
+                num_bytes_received = ((report[3] >> 4) & 0x0f) + 1
+                if error != 0:
+                    completed = self._complete(request, error=RuntimeError(
+                        "Error condition %x received during memory read!" % error))
+                elif len(request.buffer) + num_bytes_received > request.amount:
+                    completed = self._complete(request, error=RuntimeError(
+                        "Memory read received more data than requested!"))
+                else:
+                    request.buffer += report[6:6 + num_bytes_received]
+                    if len(request.buffer) == request.amount:
+                        completed = self._complete(request, result=request.buffer)
+        if completed is not None:
+            request, result, error = completed
+            if error is not None:
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(result)
+
+    def cancel_all(self, error):
+        """
+        Fails all pending requests with *error*, e.g. when disconnected.
+        """
+        with self._lock:
+            requests = list(self._in_flight) + list(self._queue)
+            self._in_flight.clear()
+            self._queue.clear()
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(error)
+
+
+def _all_futures(futures):
+    """
+    Returns a Future, which is completed when all *futures* are done,
+    immediately if there are none. It fails with the first error of them.
+    """
+    combined = Future()
+    if len(futures) == 0:
+        combined.set_result(None)
+        return combined
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def on_done(future):
+        with lock:
+            if combined.done():
+                return
+            if future.cancelled():
+                combined.cancel()
+                return
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+                return
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                combined.set_result(None)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return combined
+
+
+class Reactor(threading.Thread):
+    """
+    Receives the reports of all connected Wiimotes in one thread.
+    The data sockets are multiplexed with a selector, so a report is
+    handled as soon as it arrives, without polling. All sensor callbacks
+    are called from this thread and should therefore return quickly.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []
+        # Wakes up the selector, when handlers are added or removed.
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns the reactor shared by all Wiimotes, it is started on first use.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = Reactor()
+                cls._instance.start()
+            return cls._instance
+
+    def register(self, handler):
+        """
+        Starts receiving the reports of a CommunicationHandler.
+        """
+        self._change(True, handler)
+
+    def unregister(self, handler):
+        """
+        Stops receiving the reports of a CommunicationHandler
+        and closes its sockets.
+        """
+        self._change(False, handler)
+
+    def _change(self, add, handler):
+        # The selector is only changed by the reactor thread itself.
+        with self._lock:
+            self._pending.append((add, handler))
+        try:
+            self._wakeup_send.send(b"\x00")
+        except BlockingIOError:
+            pass  # a wakeup is pending anyway
 
+    def _apply_changes(self):
+        try:
+            while self._wakeup_recv.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        for add, handler in pending:
+            if add:
+                self._selector.register(handler._datasocket, selectors.EVENT_READ, handler)
+            else:
+                try:
+                    self._selector.unregister(handler._datasocket)
+                except (KeyError, ValueError):
+                    pass
+                handler._dispose()
+
+    def run(self):
+        while True:
+            for key, _ in self._selector.select():
+                handler = key.data
+                if handler is None:
+                    self._apply_changes()
+                    continue
+                try:
+                    handler._receive()
+                except Exception as e:
+                    print("Error while handling a Wiimote report: " + str(e))
 
-class CommunicationHandler(threading.Thread):
+
+class CommunicationHandler(object):
 
     MODE_DEFAULT = 0x30
     MODE_ACC = 0x31
@@ -592,18 +936,17 @@ class CommunicationHandler(threading.Thread):
 
     RPT_STATUS_REQ = 0x15
 
-    def __init__(self, wiimote):
-        threading.Thread.__init__(self)
-        self.daemon = True
+    def __init__(self, wiimote, socket_factory=None):
         self.rumble = False  # rumble always
+        self.running = False
         self.wiimote = wiimote
         self.btaddr = wiimote.btaddr
         self.model = wiimote.model
         self.reporting_mode = self.MODE_DEFAULT
-        self._controlsocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
-        self._controlsocket.connect((self.btaddr, 17))
-        self._datasocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
-        self._datasocket.connect((self.btaddr, 19))
+        self.report_callbacks = []
+        if socket_factory is None:
+            socket_factory = bluetooth_sockets
+        self._controlsocket, self._datasocket = socket_factory(self.btaddr)
         if self.model == 'Nintendo RVL-CNT-01':
             self._sendsocket = self._controlsocket
             self._CMD_SET_REPORT = 0x52
@@ -612,10 +955,6 @@ class CommunicationHandler(threading.Thread):
             self._CMD_SET_REPORT = 0xa2
         else:
             raise Exception("unknown model")
-        try:
-            self._datasocket.settimeout(1)
-        except NotImplementedError:
-            print("socket timeout not implemented with this bluetooth module")
         self.set_report_mode(self.MODE_ACC_IR)
 
     def _send(self, *bytes_to_send, signed=False):
@@ -627,25 +966,38 @@ class CommunicationHandler(threading.Thread):
             data_str += b.to_bytes(1, 'big', signed=signed)
         self._sendsocket.send(data_str)
 
-    def run(self):
+    def start(self):
+        """
+        Starts handling the reports of the Wiimote in the shared Reactor.
+        """
         self.running = True
-        while self.running:
-            try:
-                data = self._datasocket.recv(32)
-            except bluetooth.BluetoothError:
-                _debug("BluetoothError while waiting for data")
-                continue
-            if len(data) < 2:  # disconnect!
-                self.running = False
-            else:
-                self._handle(data)
-            time.sleep(0.001)  # Wiimote: 100 Hz, check ten times as often
-        self._dispose()
+        Reactor.get_instance().register(self)
+
+    def stop(self):
+        """
+        Stops handling reports and closes the connection.
+        """
+        if self.running:
+            self.running = False
+            Reactor.get_instance().unregister(self)
+
+    def _receive(self):
+        # Called by the Reactor, when the data socket is readable.
+        try:
+            data = self._datasocket.recv(32)
+        except (bluetooth.BluetoothError, OSError) as e:
+            _debug("Error while receiving data: " + str(e))
+            data = b""
+        if len(data) < 2:  # disconnect!
+            self.stop()
+        else:
+            self._handle(data)
 
     def _dispose(self):
         self._datasocket.close()
         self._controlsocket.close()
         self.running = False
+        self.wiimote.memory.cancel_all(ConnectionError("Wiimote disconnected"))
 
     def set_report_mode(self, mode):
         self.reporting_mode = mode
@@ -654,15 +1006,19 @@ class CommunicationHandler(threading.Thread):
     def _handle(self, bytes_read):
         _debug("received " + str(bytes_read))
         # assert(bytes_read[0] == self._CMD_SET_REPORT + 1)
-        rpt_type = bytes_read[1]
+        # The report is not copied, all handlers get the same view.
+        report = memoryview(bytes_read)[1:]
+        rpt_type = report[0]
+        for callback in self.report_callbacks:
+            callback(report)
         # all reports include button data
-        self.wiimote.buttons.handle_report(bytes_read[1:])
+        self.wiimote.buttons.handle_report(report)
         if rpt_type in Accelerometer.SUPPORTED_REPORTS:
-            self.wiimote.accelerometer.handle_report(bytes_read[1:])
+            self.wiimote.accelerometer.handle_report(report)
         if rpt_type in Memory.SUPPORTED_REPORTS:
-            self.wiimote.memory.handle_report(bytes_read[1:])
+            self.wiimote.memory.handle_report(report)
         if rpt_type in IRCam.SUPPORTED_REPORTS:
-            self.wiimote.ir.handle_report(bytes_read[1:])
+            self.wiimote.ir.handle_report(report)
 
     def set_rumble(self, state):
         self.rumble = state
@@ -672,12 +1028,19 @@ class CommunicationHandler(threading.Thread):
 
 class WiiMote(object):
 
+    # Maximum time in seconds to wait for the acknowledges of the IR camera setup.
+    IR_SETUP_TIMEOUT = 2.0
+
     # instance methods
-    def __init__(self, btaddr, model):
+    def __init__(self, btaddr, model, socket_factory=None):
         self.btaddr = btaddr
         self.model = model
         self.connected = False
-        self._com = CommunicationHandler(self)
+        # Durations of the connection phases in seconds.
+        self.timings = {}
+        start = time.perf_counter()
+        self._com = CommunicationHandler(self, socket_factory)
+        self.timings["socket_connect"] = time.perf_counter() - start
         self._leds = LEDs(self)
         self.accelerometer = Accelerometer(self)
         self.buttons = Buttons(self)
@@ -686,16 +1049,36 @@ class WiiMote(object):
         self.memory = Memory(self)
         self.ir = IRCam(self)
         """
-        Initializations before this point may not read from memory as
-        this would block forever (until the CommunicationHandler is started).
+        Initializations before this point may not wait for memory requests as
+        they are only answered after the CommunicationHandler is started.
         CommunicationHandler can not be started earlier because the sensors
         would not yet be assigned to variables
         """
         self._com.start()
+        start = time.perf_counter()
+        try:
+            self.ir.set_mode_sensitivity(self.ir._mode, self.ir._sensitivity).result(self.IR_SETUP_TIMEOUT)
+        except FutureTimeoutError:
+            print("IR camera setup of %s was not acknowledged." % btaddr)
+        except RuntimeError as e:
+            print("IR camera setup of %s failed: %s" % (btaddr, e))
+        self.timings["ir_init"] = time.perf_counter() - start
         self.leds[0] = True  # set first LED to signal successful connection.
 
     def disconnect(self):
-        self._com.running = False
+        self._com.stop()
+
+    def register_report_callback(self, func):
+        """
+        Register a callback function `func` that gets called with every raw
+        report received from the Wiimote (starting with the report type),
+        before it is handled by the sensors. Used for recording sessions.
+        """
+        self._com.report_callbacks.append(func)
+
+    def unregister_report_callback(self, func):
+        if func in self._com.report_callbacks:
+            self._com.report_callbacks.remove(func)
 
     def _get_capabilities(self):
         return None